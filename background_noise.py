@@ -0,0 +1,80 @@
+import functools
+import zlib
+
+import numpy as np
+
+NOISE_TYPES = ['uniform', 'blue']
+# side of the blue noise tile, which is repeated across the frame
+BLUE_NOISE_SIZE = 64
+# spread of the gaussian used to find clusters and voids, in pixels
+BLUE_NOISE_SIGMA = 1.5
+# share of the tile set in the starting pattern
+BLUE_NOISE_DENSITY = 0.1
+
+@functools.lru_cache(maxsize = None)
+def blue_noise_tile(size = BLUE_NOISE_SIZE, seed = 0):
+    # a tile of values from 0 up to 1 that wraps seamlessly, with its high
+    # values evenly spread rather than clumped, by void-and-cluster - points
+    # are ranked by repeatedly taking the tightest cluster out of a pattern,
+    # then filling its largest void. a point's energy is the wrapped gaussian
+    # around every point in the pattern, kept up to date as points come and go
+    rng = np.random.default_rng(seed)
+    distances = np.minimum(np.arange(size), size - np.arange(size))
+    kernel = np.exp(-(distances[:, np.newaxis] ** 2 + distances[np.newaxis, :] ** 2) / (2.0 * BLUE_NOISE_SIGMA ** 2))
+    def bump(energy, index, sign):
+        energy += sign * np.roll(kernel, np.unravel_index(index, (size, size)), axis = (0, 1)).reshape(-1)
+    pattern = rng.random(size * size) < BLUE_NOISE_DENSITY
+    energy = np.real(np.fft.ifft2(np.fft.fft2(pattern.reshape(size, size)) * np.fft.fft2(kernel))).reshape(-1)
+    # even out the starting pattern, until the tightest cluster is its own largest void
+    while True:
+        cluster = int(np.argmax(np.where(pattern, energy, -np.inf)))
+        pattern[cluster] = False
+        bump(energy, cluster, -1)
+        void = int(np.argmin(np.where(pattern, np.inf, energy)))
+        pattern[void] = True
+        bump(energy, void, 1)
+        if void == cluster:
+            break
+    ranks = np.zeros(size * size, dtype = np.int64)
+    # the starting points are ranked from the tightest cluster down...
+    remaining, remaining_energy = pattern.copy(), energy.copy()
+    for rank in range(int(pattern.sum()) - 1, -1, -1):
+        cluster = int(np.argmax(np.where(remaining, remaining_energy, -np.inf)))
+        remaining[cluster] = False
+        bump(remaining_energy, cluster, -1)
+        ranks[cluster] = rank
+    # ...and the rest by filling the largest void, until none are left
+    for rank in range(int(pattern.sum()), size * size):
+        void = int(np.argmin(np.where(pattern, np.inf, energy)))
+        pattern[void] = True
+        bump(energy, void, 1)
+        ranks[void] = rank
+    return ((ranks + 0.5) / (size * size)).astype(np.float32).reshape(size, size)
+
+class NoiseSource:
+    # noise for one frame's background, from a generator seeded by the run's
+    # seed and the frame's name - so a frame gets the same noise on every run,
+    # whichever worker it lands on. rows are handed out top to bottom, so a
+    # frame gets the same noise whether it's written whole or streamed
+    def __init__(self, kind, seed, name, width):
+        if kind not in NOISE_TYPES:
+            raise ValueError(f'unknown noise type {kind}')
+        self._kind = kind
+        self._width = width
+        self._row = 0
+        self._rng = np.random.default_rng([seed, zlib.crc32(name.encode('utf-8'))])
+        if kind == 'blue':
+            # one tile for the run, placed differently on each frame
+            self._tile = blue_noise_tile(BLUE_NOISE_SIZE, seed)
+            self._offset = self._rng.integers(0, BLUE_NOISE_SIZE, 2)
+
+    def rows(self, height):
+        # values from 0 up to 1 for the next height rows
+        if self._kind == 'uniform':
+            values = self._rng.random((height, self._width), dtype = np.float32)
+        else:
+            ys = (np.arange(self._row, self._row + height) + self._offset[0]) % BLUE_NOISE_SIZE
+            xs = (np.arange(self._width) + self._offset[1]) % BLUE_NOISE_SIZE
+            values = self._tile[ys[:, np.newaxis], xs[np.newaxis, :]]
+        self._row += height
+        return values
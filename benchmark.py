@@ -0,0 +1,194 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import Imath
+import numpy as np
+import OpenEXR
+
+import format_depthmap
+from splitter_classes import SplitManager, AUTO_LAYOUT_BINS, MAX_SPLIT_LEVELS
+
+# benchmarks for each stage of the depthmap pipeline, run against synthetic
+# EXRs generated on the spot - results are written as JSON so that runs can
+# be compared with --compare
+
+RESOLUTIONS = {
+    '1k': (1024, 576),
+    '2k': (2048, 1152),
+    '4k': (3840, 2160),
+    '8k': (7680, 4320),
+}
+DISTRIBUTIONS = ['gradient', 'planes', 'background']
+SPLIT_COUNTS = [1, 4, 16, 64]
+STAGES = ['get_exr_data', 'make_histogram', 'makeMapping', 'findSplitForDepth', 'findSplitIndices', 'makeLabelledLevels', 'autoLayout', 'write_file']
+WRITE_MODES = ['automatic', 'regions_mask', 'test', '16bit', 'npy', 'noise', 'blue_noise']
+# level budget for the 16-bit and float write modes
+WIDE_LEVELS = 1 << 16
+# tolerance for the approximate ('sketched') compression mode
+SKETCH_TOLERANCE = 0.001
+# findSplitForDepth is called per depth, so it is timed over a sample
+LOOKUP_SAMPLE = 100000
+TEST_COLOURS = ['red', 'green', 'blue', 'yellow', 'cyan', 'magenta']
+
+def make_depths(distribution, width, height, seed = 0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    if distribution == 'gradient':
+        # smooth ramps with a little render noise, so nearly every depth is distinct
+        depths = 150.0 + 250.0 * (x / width) + 50.0 * (y / height) + rng.random((height, width))
+    elif distribution == 'planes':
+        # a handful of flat cards at fixed depths
+        planes = np.array([120.0, 180.5, 240.25, 310.0, 400.0])
+        depths = planes[(x * len(planes)) // width]
+    elif distribution == 'background':
+        # a subject in the middle of the frame, everything else on the backplane
+        depths = np.full((height, width), 608.03)
+        subject = (np.abs(x - width / 2) < width / 6) & (np.abs(y - height / 2) < height / 3)
+        depths[subject] = 180.0 + 40.0 * rng.random(np.count_nonzero(subject))
+    else:
+        raise ValueError(f'unknown distribution {distribution}')
+    return depths.astype(np.float32)
+
+def write_exr(filename, depths):
+    height, width = depths.shape
+    header = OpenEXR.Header(width, height)
+    header['channels'] = {'Y': Imath.Channel(format_depthmap.FLOAT_PIXELTYPE)}
+    output = OpenEXR.OutputFile(filename, header)
+    output.writePixels({'Y': depths.tobytes()})
+    output.close()
+
+def make_split_manager(depths, splits, levels = MAX_SPLIT_LEVELS):
+    # evenly spaced splits sharing the grey levels, with region and test flags
+    min_d, max_d = float(depths.min()), float(depths.max())
+    split_manager = SplitManager(min_d, max_d, levels)
+    for index in range(1, splits):
+        split_manager.addSplit(min_d + (max_d - min_d) * index / splits)
+    for index in range(split_manager.countSplits()):
+        split_manager.allocateLevels(index, levels // splits)
+        split_manager.setFlag(index, 'REGION', str(index % 8))
+        split_manager.setFlag(index, 'TEST', TEST_COLOURS[index % len(TEST_COLOURS)])
+    return split_manager
+
+def measure(function, repeat, trace_memory):
+    # best wall time over repeat untraced runs, then one traced run for peak memory
+    best = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best == None else min(best, elapsed)
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return (best, peak)
+
+def run_case(options, workdir, resolution, distribution):
+    width, height = RESOLUTIONS[resolution]
+    depths = make_depths(distribution, width, height)
+    filename = os.path.join(workdir, f'{resolution}_{distribution}.exr')
+    write_exr(filename, depths)
+    pixels = width * height
+    results = []
+
+    def record(stage, function, splits = None, mode = None, work = pixels):
+        seconds, peak = measure(function, options.repeat, not options.no_memory)
+        result = {
+            'resolution': resolution,
+            'width': width,
+            'height': height,
+            'distribution': distribution,
+            'splits': splits,
+            'stage': stage,
+            'mode': mode,
+            'seconds': seconds,
+            'pixels_per_second': work / seconds if seconds > 0 else None,
+            'peak_bytes': peak,
+        }
+        results.append(result)
+        print(json.dumps(result), flush = True)
+
+    if 'get_exr_data' in options.stages:
+        record('get_exr_data', lambda: format_depthmap.get_exr_data(filename))
+    if 'make_histogram' in options.stages:
+        record('make_histogram', lambda: format_depthmap.make_histogram(depths))
+
+    sample = depths.reshape(-1)[np.random.default_rng(1).integers(0, pixels, min(pixels, LOOKUP_SAMPLE))].tolist()
+    for splits in options.splits:
+        split_manager = make_split_manager(depths, splits)
+        if 'makeMapping' in options.stages:
+            for compress in [False, True]:
+                record('makeMapping', lambda: split_manager.makeMapping(depths, compress), splits, 'compressed' if compress else 'linear')
+        if 'findSplitForDepth' in options.stages:
+            record('findSplitForDepth', lambda: [split_manager.findSplitForDepth(d) for d in sample], splits, work = len(sample))
+        if 'findSplitIndices' in options.stages:
+            record('findSplitIndices', lambda: split_manager.findSplitIndices(depths), splits)
+        if 'makeLabelledLevels' in options.stages:
+            for compress in [False, True]:
+                record('makeLabelledLevels', lambda: split_manager.makeLabelledLevels(depths, compress), splits, 'compressed' if compress else 'linear')
+            record('makeLabelledLevels', lambda: split_manager.makeLabelledLevels(depths, True, SKETCH_TOLERANCE), splits, 'sketched')
+        if 'autoLayout' in options.stages:
+            # the histogram is part of the cost of a layout, so is timed with it
+            def auto_layout():
+                counts, edges = format_depthmap.compute_histogram(depths, AUTO_LAYOUT_BINS)
+                SplitManager(float(depths.min()), float(depths.max())).autoLayout(counts, edges, splits)
+            record('autoLayout', auto_layout, splits)
+        if 'write_file' in options.stages:
+            wide_manager = make_split_manager(depths, splits, WIDE_LEVELS)
+            for mode in WRITE_MODES:
+                args = argparse.Namespace(compress_map = False, compress_tolerance = None, regions = mode == 'regions_mask', mask = mode == 'regions_mask', noise = mode.endswith('noise'), noise_type = 'blue' if mode == 'blue_noise' else 'uniform', noise_seed = 0, depth_format = 'npy' if mode == 'npy' else 'png')
+                manager = wide_manager if mode in ['16bit', 'npy'] else split_manager
+                record('write_file', lambda: format_depthmap.write_file(args, filename, (width, height), depths, manager, test = mode == 'test'), splits, mode)
+    os.remove(filename)
+    return results
+
+def result_key(result):
+    return (result['resolution'], result['distribution'], result['splits'], result['stage'], result['mode'])
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {result_key(r): r for r in json.load(f)['results']}
+    print('** comparison against', baseline_file, '(ratio of new time to old, below 1.00 is faster)')
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old == None or not old['seconds']:
+            continue
+        label = ' '.join(str(x) for x in result_key(result) if x != None)
+        print(f'** {label}: {result["seconds"] / old["seconds"]:.2f}x')
+
+def main(options):
+    results = []
+    with tempfile.TemporaryDirectory(dir = options.workdir) as workdir:
+        for resolution in options.resolutions:
+            for distribution in options.distributions:
+                results.extend(run_case(options, workdir, resolution, distribution))
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'results': results}, f, indent = 1)
+    if options.compare:
+        compare(results, options.compare)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolutions', nargs = '+', choices = list(RESOLUTIONS), default = ['1k', '2k', '4k'])
+    parser.add_argument('--distributions', nargs = '+', choices = DISTRIBUTIONS, default = DISTRIBUTIONS)
+    parser.add_argument('--splits', nargs = '+', type = int, default = SPLIT_COUNTS)
+    parser.add_argument('--stages', nargs = '+', choices = STAGES, default = STAGES)
+    parser.add_argument('--repeat', type = int, default = 1)
+    parser.add_argument('--no_memory', default = False, action = 'store_true')
+    parser.add_argument('--workdir', type = str, default = None)
+    parser.add_argument('--output', type = str, default = None)
+    parser.add_argument('--compare', type = str, default = None)
+    options = parser.parse_args()
+    main(options)
@@ -1,24 +1,69 @@
 import argparse
-import array
+import concurrent.futures
+import contextlib
+import copy
+import json
 import os
-import random
 import cmd
+import functools
+import io
+import signal
+import sys
+import time
+import tracemalloc
 
 import Imath
+import numpy as np
 import OpenEXR
 from PIL import Image, ImageColor
 
-from splitter_classes import SplitManager, MAX_SPLIT_LEVELS
+from background_noise import NOISE_TYPES, NoiseSource
+from frame_cache import FrameCache, cache_key, frame_identity
+from instrumentation import RECORDER, format_records, instrumented, stage
+from png_writer import NpyStreamWriter, PngStreamWriter
+from splitter_classes import SplitManager, AUTO_LAYOUT_BINS, MAX_LEVEL_BUDGET, MAX_SPLIT_LEVELS, MAPPING_BLOCK, depthThresholds
 
 FLOAT_PIXELTYPE = Imath.PixelType(Imath.PixelType.FLOAT)
+# sample types that can be read as depths, converted to float32 as they're decoded
+DEPTH_PIXELTYPES = ['FLOAT', 'HALF']
 HSV_BLACK = ImageColor.getrgb('hsv(0,0%,0%)')
+# resolution of the cached histogram the shell derives every other view from
+FINE_HISTOGRAM_BINS = 5120
+# per-frame histogram resolution kept in the sequence statistics sidecar
+SEQUENCE_HISTOGRAM_BINS = 256
+SEQUENCE_CACHE_NAME = 'depthmap_sequence.json'
+# frames already handled by --watch, kept in the watched folder unless told otherwise
+WATCH_MANIFEST_NAME = 'depthmap_watch.json'
+# default size limit of the --cache folder, in megabytes
+CACHE_SIZE = 4096
+# rough costs of processing a frame automatically, from profiles of typical
+# renders - only used to estimate a batch from the headers of its files
+PROBE_BYTES_PER_PIXEL = 20
+PROBE_COMPRESS_BYTES_PER_PIXEL = 20
+PROBE_PIXELS_PER_SECOND = 10e6
+# scanlines read and written at a time by --stream
+STREAM_BLOCK_ROWS = 64
+# splits tried by the AUTO command when not told otherwise
+AUTO_SPLITS = 8
+# smaller than MAPPING_BLOCK, as the histogram's working arrays stay in cache
+HISTOGRAM_BLOCK = 1 << 18
+# the preview pyramid stops halving below this many pixels on the short side,
+# and PREVIEW defaults to the first level whose long side fits PREVIEW_SIZE
+PREVIEW_MIN_SIZE = 32
+PREVIEW_SIZE = 512
+# shell commands that change the mapping, and so refresh an automatic preview
+PREVIEW_TRIGGERS = ['add', 'split', 'move', 'remove', 'merge', 'allocate', 'flag', 'clearflag', 'region', 'load', 'compress', 'compression', 'auto']
 
+@functools.lru_cache(maxsize = None)
 def generate_hsv_sequence(steps = 360):
+    # memoized, so it is a tuple rather than a list that callers could change
     hue_step = 180.0
     hues = []
+    used = set()
     current_hue = 0.0
     for i in range(steps):
         hues.append(current_hue)
+        used.add(current_hue)
         # attempt to find another hue
         next_hue = current_hue
         while True:
@@ -26,15 +71,20 @@ def generate_hsv_sequence(steps = 360):
             if next_hue >= 360.0:
                 hue_step /= 2.0
                 next_hue = 0.0
-            if next_hue not in hues:
+            if next_hue not in used:
                 break
         current_hue = next_hue
-    return [ImageColor.getrgb(f'hsv({h},50%,50%)') for h in hues]
+    return tuple(ImageColor.getrgb(f'hsv({h},50%,50%)') for h in hues)
 
 # tool for processing exr canvases produced by the Daz renderer
 # as a reminder, these can normally be found in 
 #  C:\Users\<you>\Documents\DAZ 3D\Studio\Render Library\
 
+def parse_channel(a):
+    # CHANNEL or CHANNEL=PRESET - a layer's channels are named LAYER.CHANNEL
+    channel, separator, preset = a.partition('=')
+    return (channel, preset if separator else None)
+
 def is_valid_file(p, a):
     if not os.path.exists(a):
         p.error(f'file {a} does not exist!')
@@ -43,69 +93,666 @@ def is_valid_file(p, a):
     else:
         return a
 
-def get_exr_data(fn):
-    file_handle = OpenEXR.InputFile(fn)
+def get_exr_dimensions(file_handle):
     data_window = file_handle.header()['dataWindow']
-    dimensions = (
+    return (
         data_window.max.x - data_window.min.x + 1, 
         data_window.max.y - data_window.min.y + 1
     )
-    depth_values = array.array('f', file_handle.channel('Y', FLOAT_PIXELTYPE)).tolist()
-    return (dimensions, depth_values)
 
-def main(args):
+def probe_exr(fn, channels = ['Y']):
+    # reads only the header, returning (dimensions, problems), where problems
+    # lists whatever would stop the channels being read as depths
+    try:
+        file_handle = OpenEXR.InputFile(fn)
+        header = file_handle.header()
+    except OSError as e:
+        return (None, [f'unable to read the header ({e})'])
+    dimensions = get_exr_dimensions(file_handle)
+    problems = []
+    available = header['channels']
+    for channel in channels:
+        if channel not in available:
+            problems.append(f'no {channel} channel, only {", ".join(sorted(available)) or "none"}')
+            continue
+        pixel_type = str(available[channel].type)
+        if pixel_type not in DEPTH_PIXELTYPES:
+            problems.append(f'{channel} channel holds {pixel_type} samples, rather than {" or ".join(DEPTH_PIXELTYPES)}')
+        if available[channel].xSampling != 1 or available[channel].ySampling != 1:
+            problems.append(f'{channel} channel is subsampled')
+    if dimensions[0] < 1 or dimensions[1] < 1:
+        problems.append(f'data window is empty ({dimensions[0]}x{dimensions[1]})')
+    if not file_handle.isComplete():
+        problems.append('file is incomplete, and may still be being written')
+    return (dimensions, problems)
+
+def probe_inputs(args):
+    # a header-only pass over every input, so that a file that can't be read
+    # stops the batch before any pixels are decoded rather than part way
+    # through - returns True if every file can be processed
+    sizes = []
+    failures = 0
     for filename in args.exrfile:
-        exr_dimensions, exr_array = get_exr_data(filename)
-        if args.interactive:
-            process_interactive(args, filename, exr_dimensions, exr_array)
+        dimensions, problems = probe_exr(filename, channel_names(args))
+        if problems:
+            failures += 1
+            print(f'** {filename} cannot be processed: {"; ".join(problems)}')
+            continue
+        sizes.append(dimensions)
+        if args.probe:
+            print(f'** {filename}: {dimensions[0]}x{dimensions[1]}')
+    if sizes and not failures and args.probe:
+        jobs = max(min(args.jobs, len(sizes)), 1)
+        pixels = sorted(width * height * len(args.channels) for width, height in sizes)
+        # the largest frames might all be in progress at once, one per job - or
+        # when streaming, a band of rows from the widest
+        if args.stream:
+            working = jobs * max(width for width, height in sizes) * args.stream_rows
         else:
-            process_automatic(args, filename, exr_dimensions, exr_array)
-
-def make_histogram(exr_array, resolution = 0.05):
-        slices = int(1.0/resolution)
-        values = len(exr_array)
-        min_d = min(exr_array)
-        max_d = max(exr_array)
-        step = (max_d - min_d)/slices
-        results = []
-        for i in range(slices):
-            step_from = min_d + (i * step)
-            step_to = min_d + ((i+1) * step) 
-            if i == (slices - 1):
-                matching = sum([1 for depth in exr_array if depth >= step_from and depth <= step_to])
-            else:
-                matching = sum([1 for depth in exr_array if depth >= step_from and depth < step_to])
-            share = matching / values * 100.0
-            results.append(f'** - {i:02} - {share:05.2f}% - {round(step_from,2)} to {round(step_to,2)}')
-        return results
+            working = sum(pixels[-jobs:])
+        per_pixel = PROBE_BYTES_PER_PIXEL + (PROBE_COMPRESS_BYTES_PER_PIXEL if args.compress_map else 0)
+        seconds = sum(pixels) / PROBE_PIXELS_PER_SECOND / jobs
+        print(f'** {len(sizes)} frames of {sum(pixels) / 1e6:.1f} megapixels in all, needing roughly {working * per_pixel / 2**20:.0f}MB at once and {seconds:.1f}s to process')
+    if failures:
+        print(f'** {failures} of {len(args.exrfile)} files cannot be processed, so none will be')
+    return failures == 0
+
+def get_exr_data(fn, channel = 'Y'):
+    dimensions, depths = get_exr_channels(fn, [channel])
+    return (dimensions, depths[channel])
+
+@instrumented('get_exr_data')
+def get_exr_channels(fn, channels):
+    # every requested channel, decoded together in one read of the file
+    file_handle = OpenEXR.InputFile(fn)
+    dimensions = get_exr_dimensions(file_handle)
+    depths = {}
+    for channel, data in zip(channels, file_handle.channels(channels, FLOAT_PIXELTYPE)):
+        # a read-only float32 view over the decoded channel buffer, shaped rows first
+        depths[channel] = np.frombuffer(data, dtype = np.float32).reshape(dimensions[1], dimensions[0])
+    return (dimensions, depths)
+
+def channel_names(args):
+    return [channel for channel, preset in args.channels]
+
+def channel_output_name(filename, channel, args):
+    # once several channels are processed, each one's outputs carry its name
+    if len(args.channels) < 2:
+        return filename
+    stub, extension = os.path.splitext(filename)
+    return f'{stub}.{channel}{extension}'
+
+def args_for_channel(args, preset):
+    # a channel given a preset of its own is processed as if that were --preset
+    if preset == None:
+        return args
+    channel_args = argparse.Namespace(**vars(args))
+    channel_args.preset = preset
+    return channel_args
+
+def open_cache(args):
+    if args.cache == None:
+        return None
+    return FrameCache(args.cache, args.cache_size * 2**20)
+
+@instrumented('load_frame')
+def load_frame(filename, channels = ['Y'], cache = None, frame = None):
+    # the decoded depths of each channel, from the cache while the file hasn't
+    # changed - its identity is taken before reading, so a file rewritten
+    # meanwhile isn't cached under its old one. whichever channels aren't
+    # cached are decoded together
+    if cache == None:
+        return get_exr_channels(filename, channels)
+    if frame == None:
+        frame = frame_identity(filename)
+    depths = {}
+    for channel in channels:
+        entry = cache.get(cache_key('depths', frame + [channel]))
+        if entry != None:
+            depths[channel] = entry[0]
+    missing = [channel for channel in channels if channel not in depths]
+    if missing:
+        exr_dimensions, decoded = get_exr_channels(filename, missing)
+        for channel, exr_array in decoded.items():
+            cache.put(cache_key('depths', frame + [channel]), exr_array)
+        depths.update(decoded)
+    exr_array = depths[channels[0]]
+    return ((exr_array.shape[1], exr_array.shape[0]), depths)
+
+def get_exr_blocks(fn, block_rows = STREAM_BLOCK_ROWS, channel = 'Y'):
+    # yields successive bands of up to block_rows scanlines, decoding only
+    # those scanlines from the file each time
+    file_handle = OpenEXR.InputFile(fn)
+    data_window = file_handle.header()['dataWindow']
+    width = data_window.max.x - data_window.min.x + 1
+    for first in range(data_window.min.y, data_window.max.y + 1, block_rows):
+        last = min(first + block_rows, data_window.max.y + 1) - 1
+        block = np.frombuffer(file_handle.channel(channel, FLOAT_PIXELTYPE, first, last), dtype = np.float32)
+        yield block.reshape(-1, width)
+
+def main(args):
+    # returns the exit status - 1 if the run stopped before processing, as
+    # for an unreadable input or script, or if any frame failed, so that
+    # callers can tell
+    if args.profile:
+        tracemalloc.start()
+    started = time.perf_counter()
+    records = []
+    failures = []
+    split_manager = None
+    # parsed once here and handed to every frame, rather than read by each
+    commands = None
+    if args.script:
+        commands, problems = read_script(args.script)
+        for problem in problems:
+            print(f'** {problem}')
+        if problems:
+            return 1
+    if args.exrfile:
+        with stage('probe'):
+            valid = probe_inputs(args)
+        records.extend(RECORDER.take())
+        if not valid:
+            return 1
+        if args.probe:
+            return 0
+    if args.sequence and not args.interactive:
+        with stage('prepare_sequence'):
+            args, split_manager = prepare_sequence(args)
+        records.extend(RECORDER.take())
+        if split_manager == None:
+            return 1
+    if args.watch:
+        records.extend(watch_folder(args, commands))
+    elif args.interactive:
+        for filename in args.exrfile:
+            exr_dimensions, exr_arrays = load_frame(filename, channel_names(args), open_cache(args))
+            records.extend(RECORDER.take())
+            # a shell for each channel in turn
+            for channel, preset in args.channels:
+                records.extend(process_interactive(args_for_channel(args, preset), channel_output_name(filename, channel, args), exr_dimensions, exr_arrays[channel]))
+    else:
+        batch_records, failures = process_batch(args, split_manager, commands)
+        records.extend(batch_records)
+    if args.profile:
+        write_profile(args.profile, records, time.perf_counter() - started)
+    return 1 if failures else 0
+
+def write_profile(filename, records, seconds):
+    with open(filename, 'w') as f:
+        json.dump({'seconds': seconds, 'stages': records}, f, indent = 1)
+    print(f'** profile of {len(records)} stages written to {filename}')
+
+def map_frames(function, filenames, jobs, *extra):
+    # yields (filename, result, error) as each file finishes, using a pool of
+    # worker processes when more than one job is requested
+    if jobs <= 1:
+        for filename in filenames:
+            try:
+                yield (filename, function(filename, *extra), None)
+            except Exception as e:
+                yield (filename, None, e)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers = jobs) as pool:
+        futures = {pool.submit(function, filename, *extra): filename for filename in filenames}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield (futures[future], future.result(), None)
+            except Exception as e:
+                yield (futures[future], None, e)
+
+def process_file(filename, args, split_manager = None, commands = None):
+    # returns the stage records for the file, so workers can report them back -
+    # raises if any output went unwritten, so the frame is counted as failed
+    if args.profile and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    RECORDER.take()
+    script_records = []
+    unwritten = []
+    with stage('frame'):
+        if args.stream:
+            for channel, preset in args.channels:
+                message, written = process_streaming(args_for_channel(args, preset), filename, split_manager, channel)
+                if not written:
+                    unwritten.append((channel_output_name(filename, channel, args), message))
+        else:
+            cache = open_cache(args)
+            frame = frame_identity(filename) if cache != None else None
+            exr_dimensions, exr_arrays = load_frame(filename, channel_names(args), cache, frame)
+            for channel, preset in args.channels:
+                channel_args = args_for_channel(args, preset)
+                output_name = channel_output_name(filename, channel, args)
+                if commands != None:
+                    channel_records, script_unwritten = process_script(channel_args, output_name, exr_dimensions, exr_arrays[channel], commands, split_manager)
+                    script_records.extend(channel_records)
+                    unwritten.extend(script_unwritten)
+                    continue
+                channel_frame = frame + [channel] if frame != None else None
+                message, written = process_automatic(channel_args, output_name, exr_dimensions, exr_arrays[channel], split_manager, cache, channel_frame)
+                if not written:
+                    unwritten.append((output_name, message))
+    if unwritten:
+        raise ValueError('; '.join(f'nothing written for {name}: {message}' for name, message in unwritten))
+    records = script_records + RECORDER.take()
+    for record in records:
+        record['file'] = filename
+    return records
+
+def process_batch(args, split_manager = None, commands = None):
+    # automatic processing fanned out over a pool of worker processes - a
+    # failing frame is reported and counted, but doesn't stop the batch
+    failures = []
+    records = []
+    started = time.perf_counter()
+    for filename, result, error in map_frames(process_file, args.exrfile, args.jobs, args, split_manager, commands):
+        if error != None:
+            print(f'** failed to process {filename}: {error!r}')
+            failures.append(filename)
+        else:
+            records.extend(result)
+    elapsed = time.perf_counter() - started
+    completed = len(args.exrfile) - len(failures)
+    print(f'** processed {completed} of {len(args.exrfile)} frames in {elapsed:.2f}s ({completed / max(elapsed, 1e-9):.2f} frames/s) across {args.jobs} jobs')
+    if failures:
+        print(f'** {len(failures)} frames failed:')
+        for filename in failures:
+            print(f'**  - {filename}')
+    return (records, failures)
+
+def ignore_interrupts():
+    # pool workers leave ^C and SIGTERM to the parent, which lets their frames
+    # finish - SIGTERM is ignored too, as a stop sent to the whole process
+    # group would otherwise reach the workers through the parent's handler
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def read_manifest(manifest_file):
+    try:
+        with open(manifest_file) as f:
+            return json.load(f).get('frames', {})
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(manifest_file, frames):
+    # written aside and moved into place, so an interrupted write can't lose it
+    try:
+        with open(f'{manifest_file}.tmp', 'w') as f:
+            json.dump({'frames': frames}, f, separators = (',', ':'))
+        os.replace(f'{manifest_file}.tmp', manifest_file)
+    except OSError as e:
+        print(f'** unable to write watch manifest {manifest_file}: {e}')
+
+def watch_folder(args, commands = None):
+    # processes .exr files as they land in a folder, until interrupted - a file
+    # is only taken once its size and modification time have held still for
+    # --watch_settle seconds, and each finished frame is noted in a manifest
+    # keyed by path, size and mtime, so a restart skips what's already done
+    manifest_file = args.watch_manifest
+    if manifest_file == None:
+        manifest_file = os.path.join(args.watch, WATCH_MANIFEST_NAME)
+    for preset in [args.preset] + [preset for channel, preset in args.channels]:
+        if preset == None:
+            continue
+        message, loaded = SplitManager(0.0, 1.0, args.levels).loadPreset(preset)
+        if not loaded:
+            print(message)
+            print('as the preset could not be applied, the folder will not be watched')
+            return []
+    frames = read_manifest(manifest_file)
+    # as a daemon, it's as likely to be stopped with SIGTERM as ^C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    settling = {}
+    running = {}
+    records = []
+    print(f'** watching {args.watch} for new renders every {args.watch_interval}s, ^C to stop')
+    with concurrent.futures.ProcessPoolExecutor(max_workers = max(args.jobs, 1), initializer = ignore_interrupts) as pool:
+        try:
+            while True:
+                now = time.monotonic()
+                busy = set(filename for filename, key in running.values())
+                with os.scandir(args.watch) as entries:
+                    found = sorted(e.path for e in entries if e.name.endswith('.exr') and e.is_file())
+                for filename in found:
+                    try:
+                        stat = os.stat(filename)
+                    except OSError:
+                        continue
+                    key = (stat.st_size, stat.st_mtime_ns)
+                    entry = frames.get(os.path.abspath(filename))
+                    if filename in busy or (entry != None and (entry['size'], entry['mtime_ns']) == key):
+                        continue
+                    # still being written for as long as it keeps changing
+                    if filename not in settling or settling[filename][0] != key:
+                        settling[filename] = (key, now)
+                    elif now - settling[filename][1] >= args.watch_settle:
+                        del settling[filename]
+                        # a file that can't be read is failed from its header
+                        # alone, and not handed to a worker
+                        dimensions, problems = probe_exr(filename, channel_names(args))
+                        if problems:
+                            print(f'** failed to process {filename}: {"; ".join(problems)}')
+                            note_watched_frame(filename, key, 'failed', frames, manifest_file)
+                            continue
+                        running[pool.submit(process_file, filename, args, None, commands)] = (filename, key)
+                for future in [f for f in running if f.done()]:
+                    records.extend(finish_watched_frame(future, running.pop(future), frames, manifest_file))
+                time.sleep(args.watch_interval)
+        except KeyboardInterrupt:
+            print(f'** stopping, once {len(running)} frames in progress are finished')
+            for future in concurrent.futures.as_completed(list(running)):
+                records.extend(finish_watched_frame(future, running.pop(future), frames, manifest_file))
+    return records
+
+def finish_watched_frame(future, submitted, frames, manifest_file):
+    # a frame that fails is noted too, and only retried once the file changes -
+    # that includes one that wrote nothing, as process_file raises for it
+    filename, key = submitted
+    try:
+        records = future.result()
+        status = 'done'
+        print(f'** processed {filename}')
+    # anything a worker raises fails just its frame, so that a stop still
+    # drains the rest
+    except BaseException as e:
+        records = []
+        status = 'failed'
+        print(f'** failed to process {filename}: {e!r}')
+    note_watched_frame(filename, key, status, frames, manifest_file)
+    return records
+
+def note_watched_frame(filename, key, status, frames, manifest_file):
+    size, mtime_ns = key
+    frames[os.path.abspath(filename)] = {'size': size, 'mtime_ns': mtime_ns, 'status': status, 'finished': time.time()}
+    write_manifest(manifest_file, frames)
+
+def frame_statistics(filename, channel = 'Y'):
+    # stat before reading, so a file rewritten mid-scan is rescanned next time
+    stat = os.stat(filename)
+    exr_dimensions, exr_array = get_exr_data(filename, channel)
+    min_d, max_d = float(exr_array.min()), float(exr_array.max())
+    counts, edges = compute_histogram(exr_array, SEQUENCE_HISTOGRAM_BINS, depth_range = (min_d, max_d))
+    return {
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'channel': channel,
+        'min': min_d,
+        'max': max_d,
+        'counts': counts.tolist(),
+    }
+
+def sequence_statistics(filenames, cache_file, jobs = 1, channel = 'Y'):
+    # depth range and histogram across a whole sequence - per-frame figures are
+    # kept in a sidecar keyed by path and mtime, so only new or changed frames are read
+    try:
+        with open(cache_file) as f:
+            frames = json.load(f).get('frames', {})
+    except (OSError, ValueError):
+        frames = {}
+    stale = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        entry = frames.get(os.path.abspath(filename))
+        if entry == None or entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size or entry.get('channel', 'Y') != channel or len(entry['counts']) != SEQUENCE_HISTOGRAM_BINS:
+            stale.append(filename)
+    if stale:
+        print(f'** scanning {len(stale)} of {len(filenames)} frames for sequence depth statistics')
+        for filename, entry, error in map_frames(frame_statistics, stale, jobs, channel):
+            if error != None:
+                print(f'** unable to scan {filename}, leaving it out of the sequence: {error!r}')
+                continue
+            frames[os.path.abspath(filename)] = entry
+        try:
+            with open(cache_file, 'w') as f:
+                json.dump({'frames': frames}, f, separators = (',', ':'))
+        except OSError as e:
+            print(f'** unable to write sequence statistics to {cache_file}: {e}')
+    entries = [frames[os.path.abspath(f)] for f in filenames if os.path.abspath(f) in frames]
+    if not entries:
+        return None
+    min_d = min(e['min'] for e in entries)
+    max_d = max(e['max'] for e in entries)
+    edges = histogram_edges(min_d, max_d, SEQUENCE_HISTOGRAM_BINS)
+    counts = np.zeros(SEQUENCE_HISTOGRAM_BINS, dtype = np.int64)
+    for e in entries:
+        frame_edges = histogram_edges(e['min'], e['max'], SEQUENCE_HISTOGRAM_BINS)
+        counts += rebin_histogram(np.array(e['counts']), frame_edges, edges)
+    return (min_d, max_d, counts, edges)
+
+def prepare_sequence(args):
+    # one SplitManager for the whole sequence, spanning the depths of every
+    # frame, so a given depth maps to the same grey level throughout
+    cache_file = args.sequence_cache
+    if cache_file == None:
+        cache_file = os.path.join(os.path.dirname(os.path.abspath(args.exrfile[0])), SEQUENCE_CACHE_NAME)
+    # a sequence is always of a single channel, which may bring its own preset
+    channel, preset = args.channels[0]
+    args = args_for_channel(args, preset)
+    statistics = sequence_statistics(args.exrfile, cache_file, args.jobs, channel)
+    if statistics == None:
+        print('** no frames could be scanned, so the sequence will not be processed')
+        return (args, None)
+    min_d, max_d, counts, edges = statistics
+    if args.depth_cutoff == 'histo':
+        print('** providing cutting histogram advice for the whole sequence, but leaving depthmaps unchanged')
+        advice_edges = histogram_edges(min_d, max_d)
+        for line in format_histogram(rebin_histogram(counts, edges, advice_edges), advice_edges):
+            print(line)
+        # the advice has been given once, so the frames needn't repeat it
+        args = argparse.Namespace(**vars(args))
+        args.depth_cutoff = None
+    elif args.depth_cutoff != None:
+        max_d = min(max_d, float(np.float32(args.depth_cutoff)))
+    def histogram():
+        layout_edges = histogram_edges(min_d, max_d, SEQUENCE_HISTOGRAM_BINS)
+        layout_counts = rebin_histogram(counts, edges, layout_edges)
+        # depths past a cutoff are clamped to it, so they count at the far edge
+        layout_counts[-1] += counts.sum() - layout_counts.sum()
+        return (layout_counts, layout_edges)
+    message, split_manager = lay_out_splits(args, min_d, max_d, histogram, prefix = '** ')
+    return (args, split_manager)
+
+def histogram_edges(min_d, max_d, bins = 20, log = False):
+    if log:
+        # bins widen geometrically with distance from the nearest depth
+        edges = min_d - 1.0 + np.geomspace(1.0, max_d - min_d + 1.0, bins + 1)
+    else:
+        edges = min_d + np.arange(bins + 1) * ((max_d - min_d)/bins)
+    edges[0], edges[-1] = min_d, max_d
+    return edges
+
+@instrumented('compute_histogram', 0)
+def compute_histogram(exr_array, bins = 20, log = False, depth_range = None):
+    # counts depths into half-open bins (the last one closed) in a single pass,
+    # returning (counts, edges) - depths outside the range are not counted
+    if depth_range == None:
+        depth_range = (float(exr_array.min()), float(exr_array.max()))
+    edges = histogram_edges(depth_range[0], depth_range[1], bins, log)
+    thresholds = depthThresholds(edges, exr_array.dtype)
+    if thresholds[-1] == edges[-1]:
+        thresholds[-1] = np.nextafter(thresholds[-1], thresholds.dtype.type(np.inf))
+    flat = exr_array.reshape(-1)
+    counts = np.zeros(bins + 2, dtype = np.int64)
+    # the arithmetic below needs bins a few steps of the depths' own precision
+    # wide, or a guess can be more than one bin out
+    precision = float(np.spacing(thresholds.dtype.type(max(abs(depth_range[0]), abs(depth_range[1])))))
+    if log or not (depth_range[1] - depth_range[0]) / bins > 4 * precision or bins >= 2 ** 19:
+        for block in range(0, flat.size, MAPPING_BLOCK):
+            indices = np.searchsorted(thresholds, flat[block:block + MAPPING_BLOCK], side = 'right')
+            counts += np.bincount(indices, minlength = bins + 2)
+        return (counts[1:-1], edges)
+    # evenly spaced bins can be found by arithmetic rather than a search -
+    # rounding can leave a guess a bin out either way, so each is checked
+    # against the thresholds either side. fmax turns NaN guesses into 0, and
+    # comparisons with NaN are false, so NaN depths land below the range, and
+    # the NaN after the last threshold keeps infinite depths in the last slot
+    padded = np.concatenate([[-np.inf], thresholds, [np.nan]]).astype(thresholds.dtype)
+    low = thresholds.dtype.type(depth_range[0])
+    scale = thresholds.dtype.type(bins / (depth_range[1] - depth_range[0]))
+    for block in range(0, flat.size, HISTOGRAM_BLOCK):
+        depths = flat[block:block + HISTOGRAM_BLOCK]
+        guess = depths - low
+        guess *= scale
+        guess += 1
+        np.fmax(guess, 0, out = guess)
+        np.fmin(guess, bins + 1, out = guess)
+        indices = guess.astype(np.intp)
+        indices -= padded[indices] > depths
+        indices += padded[indices + 1] <= depths
+        counts += np.bincount(indices, minlength = bins + 2)
+    return (counts[1:-1], edges)
+
+def rebin_histogram(counts, edges, new_edges):
+    # regroups a fine histogram into coarser bins by the centre of each fine bin
+    centres = (edges[:-1] + edges[1:]) / 2.0
+    inside = (centres >= new_edges[0]) & (centres <= new_edges[-1])
+    indices = np.clip(np.searchsorted(new_edges, centres[inside], side = 'right') - 1, 0, len(new_edges) - 2)
+    return np.bincount(indices, weights = counts[inside], minlength = len(new_edges) - 1).astype(np.int64)
+
+def format_histogram(counts, edges):
+    values = max(int(counts.sum()), 1)
+    results = []
+    for i in range(len(counts)):
+        share = counts[i] / values * 100.0
+        results.append(f'** - {i:02} - {share:05.2f}% - {round(float(edges[i]),2)} to {round(float(edges[i + 1]),2)}')
+    return results
+
+def make_histogram(exr_array, resolution = 0.05, log = False):
+    counts, edges = compute_histogram(exr_array, int(1.0/resolution), log)
+    return format_histogram(counts, edges)
+
+def build_pyramid(exr_array, smallest = PREVIEW_MIN_SIZE):
+    # successively halved copies of the depth buffer, keyed by scale divisor -
+    # point sampled rather than averaged, so that every preview pixel is a
+    # real depth and object edges don't blend into the background
+    pyramid = {1: exr_array}
+    level = exr_array
+    while min(level.shape) >= 2 * smallest:
+        level = np.ascontiguousarray(level[::2, ::2])
+        pyramid[max(pyramid) * 2] = level
+    return pyramid
 
 class DepthShell(cmd.Cmd):
     intro = 'Welcome to the interactive shell. Type help or ? to list commands.'
     prompt = '> '
 
-    def prime(self, args, filename, exr_dimensions, exr_array):
+    def prime(self, args, filename, exr_dimensions, exr_array, split_manager = None):
         self._args = args
         self._filename = filename
         self._dimensions = exr_dimensions
         self._points = exr_array
-        self._sm = SplitManager(min(self._points), max(self._points))
+        self._min_depth = float(exr_array.min())
+        self._max_depth = float(exr_array.max())
+        self._sm = SplitManager(self._min_depth, self._max_depth, args.levels)
+        self._histogram = None
+        self._mapping = None
+        # only built once a preview is asked for
+        self._pyramid = None
+        self._auto_preview = False
+        self._last_stats = []
+        self._all_stats = []
+        # (filename, message) for each WRITE or TEST that wrote nothing
+        self._unwritten = []
 
-        if args.depth_cutoff not in ['histo', None]:
+        # a sequence's shared splits are the starting point for each of its frames
+        if split_manager != None:
+            self._sm = copy.deepcopy(split_manager)
+        elif args.preset:
+            self.do_load(args.preset)
+        elif args.auto_splits:
+            self.do_auto(str(args.auto_splits))
+        elif args.depth_cutoff not in ['histo', None]:
             cutoff_point = float(args.depth_cutoff)
             self._sm.addSplit(cutoff_point)
             self.do_rename('1 Cutoff')
         elif args.depth_cutoff == 'histo':
             self.do_histogram(None)
 
+    def precmd(self, line):
+        RECORDER.take()
+        return line
+
+    def postcmd(self, stop, line):
+        if line.split(' ')[0].lower() != 'stats':
+            self._last_stats = RECORDER.take()
+            self._all_stats.extend(self._last_stats)
+        if self._auto_preview and line.split(' ')[0].lower() in PREVIEW_TRIGGERS:
+            self.write_preview(None)
+        return stop
+
+    def write_preview(self, divisor):
+        if self._pyramid == None:
+            self._pyramid = build_pyramid(self._points)
+        if divisor == None:
+            # the first level small enough to fit a thumbnail
+            fitting = [d for d in self._pyramid if max(self._pyramid[d].shape) <= PREVIEW_SIZE]
+            divisor = min(fitting) if fitting else max(self._pyramid)
+        else:
+            # the nearest level no coarser than asked for
+            divisor = max([d for d in self._pyramid if d <= divisor] or [1])
+        points = self._pyramid[divisor]
+        message, mapping = self._sm.makeLabelledLevels(points, self._args.compress_map, self._args.compress_tolerance)
+        if mapping == None:
+            print(f'Unable to preview: {message}')
+            return
+        levels, labels = mapping
+        preview_args = argparse.Namespace(**vars(self._args))
+        preview_args.mask = False
+        preview_args.noise = False
+        outputs = render_outputs(preview_args, levels, labels, split_tables(self._sm), None)
+        filename_stub = os.path.splitext(self._filename)[0]
+        for name, pixels in outputs.items():
+            save_image(pixels, f'{filename_stub}.preview.{name}.{output_extension(self._args, name)}')
+        print(f'Preview written at 1/{divisor} scale ({points.shape[1]}x{points.shape[0]}).')
+
+    def mapping(self):
+        # levels and labels for every pixel, kept between commands and only
+        # recomputed for the splits that have been edited since
+        message, mapping = self._sm.remapLabelledLevels(self._points, self._mapping, self._args.compress_map, self._args.compress_tolerance)
+        if mapping != None:
+            self._mapping = mapping
+        return (message, mapping)
+
+    def histogram(self):
+        # built on first use and kept for the life of the file - every other
+        # histogram the shell shows is regrouped from these fine bins
+        if self._histogram == None:
+            self._histogram = compute_histogram(self._points, FINE_HISTOGRAM_BINS, depth_range = (self._min_depth, self._max_depth))
+        return self._histogram
+
+    def split_histogram(self, start, end, bins = 20, log = False):
+        fine_counts, fine_edges = self.histogram()
+        centres = (fine_edges[:-1] + fine_edges[1:]) / 2.0
+        occupied = np.nonzero((fine_counts > 0) & (centres >= start) & (centres < end))[0]
+        if len(occupied) == 0:
+            return None
+        low = max(start, float(fine_edges[occupied[0]]))
+        high = min(end, float(fine_edges[occupied[-1] + 1]))
+        edges = histogram_edges(low, high, bins, log)
+        return (rebin_histogram(fine_counts, fine_edges, edges), edges)
+
     def do_histogram(self, args):
-        'Show the histogram of the loaded depthmap. HISTOGRAM'
-        for line in make_histogram(self._points):
+        'Show the histogram of the loaded depthmap. HISTOGRAM or HISTOGRAM {bins} or HISTOGRAM {bins} LOG'
+        pieces = args.split(' ') if args else []
+        bins = int(pieces[0]) if len(pieces) > 0 else 20
+        log = len(pieces) > 1 and pieces[1].lower() == 'log'
+        fine_counts, fine_edges = self.histogram()
+        edges = histogram_edges(self._min_depth, self._max_depth, bins, log)
+        for line in format_histogram(rebin_histogram(fine_counts, fine_edges, edges), edges):
             print(line)
 
+    def do_auto(self, args):
+        'Replace the splits with a layout of up to {splits} splits (8 by default), placed and given levels to keep the error in depth low. Existing flags are not kept. AUTO or AUTO {splits}'
+        splits = int(args) if args else AUTO_SPLITS
+        fine_counts, fine_edges = self.histogram()
+        message, laid_out = self._sm.autoLayout(fine_counts, fine_edges, splits)
+        print(message)
+        if laid_out:
+            self.do_show_splits()
+
     def do_show_splits(self, args = None):
         'Show the current splits. SHOW_SPLITS'
         for index in range(self._sm.countSplits()):
-            result, info = self._sm.information(index, self._points)
+            result, info = self._sm.information(index)
             if info == None:
                 print(result)
                 continue
@@ -143,9 +790,9 @@ class DepthShell(cmd.Cmd):
         message, valid = self._sm.totalLevels()
         print(message)
         if valid:
-            print(f'Does not exceed maximum allocable levels, {MAX_SPLIT_LEVELS}.')
+            print(f'Does not exceed maximum allocable levels, {self._sm.maxLevels()}.')
         else:
-            print(f'Exceeds maximum allocable levels, {MAX_SPLIT_LEVELS}.')
+            print(f'Exceeds maximum allocable levels, {self._sm.maxLevels()}.')
 
     def do_flag(self, args):
         'Set or retrieve a flag on a split. FLAG {index} {flag} {value} or FLAG {index} {flag} or FLAG {index}'
@@ -196,10 +843,10 @@ class DepthShell(cmd.Cmd):
     def do_add(self, args):
         'Add a split at a specified depth. ADD {depth}'
         insertion_point = float(args)
-        if insertion_point < min(self._points):
-            insertion_point = min(self._points) + 0.01
-        if insertion_point > max(self._points):
-            insertion_point = max(self._points) - 0.01
+        if insertion_point < self._min_depth:
+            insertion_point = self._min_depth + 0.01
+        if insertion_point > self._max_depth:
+            insertion_point = self._max_depth - 0.01
         message, newSplit = self._sm.addSplit(insertion_point)
         print(message)
 
@@ -224,36 +871,79 @@ class DepthShell(cmd.Cmd):
         'Get the depth of a particular x y pixel in the depthmap. GET {x} {y}'
         pieces = [int(x) for x in args.split(' ')]
         offset = pieces[1] * self._dimensions[0] + pieces[0]
-        print(f'Value at {pieces[0]}:{pieces[1]} (offset {offset}): {self._points[offset]}')
+        print(f'Value at {pieces[0]}:{pieces[1]} (offset {offset}): {float(self._points[pieces[1], pieces[0]])}')
 
     def do_inspect(self, args):
-        'Get information on a particular slice. INSPECT {index}'
+        'Get information on a particular slice. Point figures are read from the cached histogram, so are accurate to one of its bins. INSPECT {index}'
         inspect_index = int(args)
-        message, information = self._sm.information(inspect_index, self._points)
+        message, information = self._sm.information(inspect_index)
         if information == None:
             print(message)
         else:
+            histo = self.split_histogram(information['start'], information['end'])
+            if histo != None:
+                counts, edges = histo
+                information.update({
+                    'point_count': int(counts.sum()),
+                    'point_max': float(edges[-1]),
+                    'point_min': float(edges[0]),
+                })
             print(f'Split {inspect_index:03}:')
             for k,v in information.items():
-                if k == 'points':
-                    continue
                 print(f' - {k}: {v}')           
             print('Histogram:')
-            histo = make_histogram(information['points'])
-            for line in histo:
-                print(f' - {line}')
+            if histo == None:
+                print(' - no points in this split')
+            else:
+                for line in format_histogram(counts, edges):
+                    print(f' - {line}')
 
     def do_test(self, args):
         'Write a test map. Splits will be colored according to their TEST tag. TEST {filename} or just TEST'
         if args == '':
             args = self._filename
-        write_file(self._args, args, self._dimensions, self._points, self._sm, test = True)
+        self.note_written(args, write_file(self._args, args, self._dimensions, self._points, self._sm, test = True, mapping = self.mapping()))
 
     def do_write(self, args):
         'Write a depthmap to disk. WRITE {filename} or just WRITE'
         if args == '':
             args = self._filename
-        write_file(self._args, args, self._dimensions, self._points, self._sm)
+        self.note_written(args, write_file(self._args, args, self._dimensions, self._points, self._sm, mapping = self.mapping()))
+
+    def note_written(self, filename, result):
+        message, written = result
+        if not written:
+            self._unwritten.append((filename, message))
+
+    def do_save(self, args):
+        'Save the current splits, levels and flags as a preset for use with LOAD or --preset. SAVE {filename}'
+        if args == '':
+            args = f'{os.path.splitext(self._filename)[0]}.preset.json'
+        message, result = self._sm.savePreset(args)
+        print(message)
+
+    def do_load(self, args):
+        'Replace the current splits with those from a preset file. LOAD {filename}'
+        message, result = self._sm.loadPreset(args)
+        print(message)
+
+    def do_preview(self, args):
+        'Write a quick, scaled-down depthmap (and region map, with --regions) to {file}.preview.depth.png. AUTO turns on rewriting it after every edit. PREVIEW or PREVIEW {divisor} or PREVIEW AUTO {ON|OFF}'
+        pieces = args.lower().split(' ') if args else []
+        if len(pieces) == 0:
+            self.write_preview(None)
+        elif pieces[0] == 'auto':
+            self._auto_preview = pieces[1] != 'off' if len(pieces) > 1 else not self._auto_preview
+            print(f'Automatic preview toggled, now: {self._auto_preview}.')
+        else:
+            self.write_preview(int(pieces[0]))
+
+    def do_stats(self, args):
+        'Show how long each stage of the last command took. Memory figures need --profile. STATS'
+        if not self._last_stats:
+            print('No stages were recorded for the last command.')
+        for line in format_records(self._last_stats):
+            print(line)
 
     def do_exit(self, args):
         'Synonym for QUIT'
@@ -266,107 +956,409 @@ def process_interactive(args, filename, exr_dimensions, exr_array):
     shell = DepthShell()
     shell.prime(args, filename, exr_dimensions, exr_array)
     shell.cmdloop()
+    return shell._all_stats
+
+def process_script(args, filename, exr_dimensions, exr_array, commands, split_manager = None):
+    # runs a script through a shell for the file, just as if it were typed in -
+    # nothing is mapped until a command needs it, as with WRITE or TEST
+    records = RECORDER.take()
+    shell = DepthShell()
+    # the script's own copy of the options, as COMPRESSION changes them
+    shell.prime(argparse.Namespace(**vars(args)), filename, exr_dimensions, exr_array, split_manager)
+    for line in commands:
+        line = shell.precmd(line)
+        if not args.quiet:
+            if shell.postcmd(shell.onecmd(line), line):
+                break
+            continue
+        # quietly, only a command's errors are passed on
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            stop = shell.postcmd(shell.onecmd(line), line)
+        for message in output.getvalue().splitlines():
+            if message.startswith(('Error', 'Unable')):
+                print(f'** {filename}: {line}: {message}')
+        if stop:
+            break
+    return (records + shell._all_stats, shell._unwritten)
+
+def read_script(filename):
+    # shell commands, one to a line, skipping blank lines and # comments -
+    # returns (commands, problems), with a problem for each line the shell
+    # has no command for. commands can be written in either case, as they
+    # are in the shell's help
+    try:
+        with open(filename) as f:
+            lines = [line.strip() for line in f]
+    except OSError as e:
+        return ([], [f'unable to read script {filename}: {e}'])
+    commands = []
+    problems = []
+    shell = DepthShell()
+    for line in lines:
+        if not line or line.startswith('#'):
+            continue
+        command, arguments, line = shell.parseline(line)
+        if not command or not hasattr(shell, f'do_{command.lower()}'):
+            problems.append(f'unknown command in script {filename}: {line}')
+            continue
+        commands.append(f'{command.lower()} {arguments}'.strip())
+    return (commands, problems)
+
+def depth_cutoff_value(args):
+    # the numeric cutoff, if any - 'histo' asks for advice rather than a cut
+    if args.depth_cutoff in ['histo', None]:
+        return None
+    return float(args.depth_cutoff)
 
-def process_automatic(args, filename, exr_dimensions, exr_array):
-    if args.depth_cutoff == None:
-        depth_cutoff = None
-    elif args.depth_cutoff == 'histo':
+def lay_out_splits(args, min_d, max_d, histogram, prefix = ''):
+    # a manager spanning min_d to max_d, laid out from --preset or, with
+    # --auto_splits, from histogram() - called only then, it returns the
+    # (counts, edges) to lay out over. the manager is None if nothing should
+    # be written
+    split_manager = SplitManager(min_d, max_d, args.levels)
+    if args.preset:
+        message, loaded = split_manager.loadPreset(args.preset)
+        if not loaded:
+            print(message)
+            print('as the preset could not be applied, no files will be written')
+            return (message, None)
+    elif args.auto_splits:
+        counts, edges = histogram()
+        message, laid_out = split_manager.autoLayout(counts, edges, args.auto_splits)
+        print(f'{prefix}{message}')
+        if not laid_out:
+            print('as no layout could be found, no files will be written')
+            return (message, None)
+    return ('Success', split_manager)
+
+@instrumented('process_automatic', 3)
+def process_automatic(args, filename, exr_dimensions, exr_array, split_manager = None, cache = None, frame = None):
+    if args.depth_cutoff == 'histo':
         print('** providing cutting histogram advice, but leaving depthmap unchanged')
         for line in make_histogram(exr_array):
             print(line)
-        depth_cutoff = None
-    else:
-        depth_cutoff = float(args.depth_cutoff)
+    depth_cutoff = depth_cutoff_value(args)
     if depth_cutoff:
-        exr_array = [min(y, depth_cutoff) for y in exr_array]
-    split_manager = SplitManager(min(exr_array), max(exr_array))
-    write_file(args, filename, exr_dimensions, exr_array, split_manager)
+        exr_array = np.minimum(exr_array, np.float32(depth_cutoff))
+    # a manager shared across a sequence arrives ready-made
+    if split_manager == None:
+        message, split_manager = lay_out_splits(args, float(exr_array.min()), float(exr_array.max()),
+            lambda: cached_histogram(cache, frame, depth_cutoff, exr_array, AUTO_LAYOUT_BINS))
+        if split_manager == None:
+            return (message, False)
+    mapping = None
+    if cache != None:
+        mapping = cached_mapping(args, cache, frame, exr_array, split_manager)
+    return write_file(args, filename, exr_dimensions, exr_array, split_manager, mapping = mapping)
 
-def write_file(args, filename, dimensions, points, splitmanager, test = False):
-    filename_stub = os.path.splitext(filename)[0]
+def cached_histogram(cache, frame, depth_cutoff, exr_array, bins):
+    if cache == None:
+        return compute_histogram(exr_array, bins)
+    key = cache_key('histogram', frame, depth_cutoff, bins)
+    entry = cache.get(key)
+    if entry == None:
+        entry = compute_histogram(exr_array, bins)
+        cache.put(key, *entry)
+    return entry
+
+@instrumented('cached_mapping', 2)
+def cached_mapping(args, cache, frame, exr_array, split_manager):
+    # levels and labels are worked out again only if the frame, its cutoff or
+    # the splits' bounds and levels have changed, so a re-run that just asks
+    # for other outputs goes straight to rendering them
+    key = cache_key('mapping', frame, depth_cutoff_value(args), split_manager.mappingConfig(), args.compress_map, args.compress_tolerance)
+    entry = cache.get(key)
+    if entry != None:
+        return ('Success', tuple(a.astype(np.int32) for a in entry))
+    message, mapping = split_manager.makeLabelledLevels(exr_array, args.compress_map, args.compress_tolerance)
+    if mapping != None:
+        # levels never pass 65535, and labels seldom do, so both are kept at
+        # half the size
+        narrow = np.uint16 if split_manager.countSplits() < 2**16 else np.int32
+        cache.put(key, mapping[0].astype(np.uint16), mapping[1].astype(narrow))
+    return (message, mapping)
 
-    # map the points with the provided splitmanager
-    mapping_results, mapping = splitmanager.makeMapping(points, args.compress_map)
+@instrumented('process_streaming')
+def process_streaming(args, filename, split_manager = None, channel = 'Y'):
+    # automatic processing a band of scanlines at a time, so peak memory
+    # follows --stream_rows rather than the size of the frame
+    filename_stub = os.path.splitext(channel_output_name(filename, channel, args))[0]
+    depth_cutoff = depth_cutoff_value(args)
+    def blocks():
+        for block in get_exr_blocks(filename, args.stream_rows, channel):
+            yield np.minimum(block, np.float32(depth_cutoff)) if depth_cutoff else block
+
+    # first pass - the depth range, plus every distinct depth when compressing
+    # exactly
+    exact_compress = args.compress_map and not args.compress_tolerance
+    min_d, max_d = np.inf, -np.inf
+    distinct = np.empty(0, dtype = np.float32)
+    # each band's distinct depths are merged in only once they outnumber
+    # those already merged, so the whole set isn't re-sorted for every band
+    pending, pending_size = [], 0
+    if split_manager == None or exact_compress or args.depth_cutoff == 'histo':
+        for block in blocks():
+            min_d = min(min_d, float(block.min()))
+            max_d = max(max_d, float(block.max()))
+            if exact_compress:
+                pending.append(np.unique(block))
+                pending_size += pending[-1].size
+                if pending_size > distinct.size:
+                    distinct = np.unique(np.concatenate([distinct] + pending))
+                    pending, pending_size = [], 0
+        if pending:
+            distinct = np.unique(np.concatenate([distinct] + pending))
+    if args.depth_cutoff == 'histo':
+        print('** providing cutting histogram advice, but leaving depthmap unchanged')
+        counts, edges = None, None
+        for block in blocks():
+            block_counts, edges = compute_histogram(block, depth_range = (min_d, max_d))
+            counts = block_counts if counts is None else counts + block_counts
+        for line in format_histogram(counts, edges):
+            print(line)
+    if split_manager == None:
+        def histogram():
+            counts = None
+            for block in blocks():
+                block_counts, edges = compute_histogram(block, AUTO_LAYOUT_BINS, depth_range = (min_d, max_d))
+                counts = block_counts if counts is None else counts + block_counts
+            return (counts, edges)
+        message, split_manager = lay_out_splits(args, min_d, max_d, histogram)
+        if split_manager == None:
+            return (message, False)
+
+    # each band maps to a (levels, labels) pair
+    if args.compress_map and args.compress_tolerance:
+        # approximate compression needs its sketch of the whole frame first
+        sketch = None
+        for block in blocks():
+            sketch = split_manager.makeLevelSketch(block, args.compress_tolerance, sketch)
+        mapping_results, table = split_manager.makeLevelTable(distinct, False)
+        map_block = lambda block: split_manager.makeSketchedLevels(block, sketch)[1]
+    elif args.compress_map:
+        mapping_results, table = split_manager.makeLevelTable(distinct, True)
+        def map_block(block):
+            # looking up the band's own distinct depths, in order, keeps the
+            # search through every depth in the frame cache friendly
+            values, inverse = np.unique(block, return_inverse = True)
+            levels = table[np.searchsorted(distinct, values)][inverse].reshape(block.shape)
+            return (levels, split_manager.findSplitIndices(block))
+    else:
+        mapping_results, table = split_manager.makeLevelTable(distinct, False)
+        map_block = lambda block: split_manager.makeLabelledLevels(block)[1]
     print(f'mapping status was: {mapping_results}')
     if(mapping_results != 'Success'):
         print('as the mapping process was unsuccessful, no files will be written')
         print('(did you allocate too many levels?)')
-        return
-    
-    mapped = [mapping.get(y, MAX_SPLIT_LEVELS - 1) for y in points]
+        return (mapping_results, False)
+
+    # the mask needs the deepest level in the frame before any row is written
+    maximal = None
+    if args.mask:
+        maximal = max(int(map_block(block)[0].max()) for block in blocks())
+
+    width, height = get_exr_dimensions(OpenEXR.InputFile(filename))
+    tables = split_tables(split_manager)
+    with contextlib.ExitStack() as stack:
+        if args.depth_format == 'npy':
+            writers = {'depth': stack.enter_context(NpyStreamWriter(f'{filename_stub}.depth.npy', width, height))}
+        else:
+            mode = 'L' if split_manager.maxLevels() <= MAX_SPLIT_LEVELS else 'I;16'
+            writers = {'depth': stack.enter_context(PngStreamWriter(f'{filename_stub}.depth.png', width, height, mode))}
+        if args.mask:
+            writers['mask'] = stack.enter_context(PngStreamWriter(f'{filename_stub}.mask.png', width, height))
+        if args.regions:
+            writers['regions'] = stack.enter_context(PngStreamWriter(f'{filename_stub}.regions.png', width, height, 'RGB'))
+        noise = frame_noise(args, filename_stub, width)
+        for block in blocks():
+            levels, labels = map_block(block)
+            for name, pixels in render_outputs(args, levels, labels, tables, maximal, noise = noise).items():
+                writers[name].writeRows(pixels)
+    return (mapping_results, True)
+
+def split_tables(splitmanager):
+    # per-split lookup tables for the coloured outputs, each with a trailing
+    # entry for pixels that no split owns
+    split_count = splitmanager.countSplits()
+    split_regions = [splitmanager.getFlag(index, 'REGION')[1] for index in range(split_count)]
+    split_regions = np.array([int(r) if r != None else -1 for r in split_regions] + [-1], dtype = np.int64)
+    # each split's region colour, from a palette of one colour per region
+    region_colours = np.zeros((split_count + 1, 3), dtype = np.uint8)
+    region_coloured = split_regions >= 0
+    if region_coloured.any():
+        palette = np.array(generate_hsv_sequence(int(split_regions.max()) + 1), dtype = np.uint8)
+        region_colours[region_coloured] = palette[split_regions[region_coloured]]
+    test_colours = np.zeros((split_count + 1, 3), dtype = np.uint8)
+    test_coloured = np.zeros(split_count + 1, dtype = bool)
+    for index in range(split_count):
+        test_colour = splitmanager.getFlag(index, 'TEST')[1]
+        if test_colour:
+            test_colours[index] = ImageColor.getrgb(test_colour)[:3]
+            test_coloured[index] = True
+    return {
+        'levels': splitmanager.maxLevels(),
+        'regions': (region_colours, region_coloured),
+        'test': (test_colours, test_coloured),
+    }
+
+def frame_noise(args, filename_stub, width):
+    # keyed by the output's name, so a frame's noise doesn't depend on where
+    # it's written or which worker writes it
+    if not args.noise:
+        return None
+    return NoiseSource(args.noise_type, args.noise_seed, os.path.basename(filename_stub), width)
+
+def render_outputs(args, levels, labels, tables, maximal, test = False, noise = None):
+    # every requested image for a whole frame or a band of its rows, all
+    # built from one array of levels and one of owning split labels - the
+    # background is filled from noise when given a source for it
+    outputs = {}
+    # levels are inverted, so that near is bright, then stretched to fill an
+    # 8-bit image, or a 16-bit one for budgets of more than 256 levels, or
+    # 0 to 1 for a float map
+    top = tables['levels'] - 1
+    inverted = np.clip(top - levels, 0, top)
+    grey = stretch_levels(inverted, top, 255).astype(np.uint8)
+    if args.depth_format == 'npy':
+        depth = inverted.astype(np.float32) / np.float32(top)
+    elif top > 255:
+        depth = stretch_levels(inverted, top, 65535).astype(np.uint16)
+    else:
+        depth = grey
 
     # recolour the map using the TEST tag on the relevant splits
     if test:
-        # invert and turn to rgb
-        debug_pixels = [(255 - y) for y in mapped]
-        debug_pixels = [(x,x,x) for x in debug_pixels]
-        for index in range(len(points)):
-            depth = points[index]
-            message, owner = splitmanager.findSplitForDepth(depth)
-            if owner != None:
-                debug_colour = owner.getFlag('TEST', None)
-                if debug_colour:
-                    debug_pixels[index] = ImageColor.getrgb(debug_colour)
-            else:
-                print(message)
-        debug_file = Image.new('RGB', dimensions)
-        debug_file.putdata(debug_pixels)
-        debug_file.save(f'{filename_stub}.test.png')
-        # early exit
-        return
+        outputs['test'] = colour_splits(tables['test'], labels, grey)
+        return outputs
 
     if args.regions:
-        # invert and turn to rgb
-        region_pixels = [(255 - y) for y in mapped]
-        region_pixels = [(x,x,x) for x in region_pixels]
-        regions = []
-        for index in range(len(points)):
-            depth = points[index]
-            message, owner = splitmanager.findSplitForDepth(depth)
-            if owner != None:
-                region = int(owner.getFlag('REGION', -1))
-                regions.append(region)
-            else:
-                print(message)
-                regions.append(-1)
-        
-        if max(regions) > -1:
-            hsv_values = generate_hsv_sequence(max(regions) + 1)
-            for index in range(len(points)):
-                region = regions[index]
-                if region == -1 or region >= len(hsv_values):
-                    continue
-                region_pixels[index] = hsv_values[region]
-        
-        region_file = Image.new('RGB', dimensions)
-        region_file.putdata(region_pixels)
-        region_file.save(f'{filename_stub}.regions.png')
+        outputs['regions'] = colour_splits(tables['regions'], labels, grey)
 
     if args.mask:
-        maximal = max(mapped)
-        mask = [0 if x == maximal else 255 for x in mapped]
-        output_mask = Image.new('L', dimensions)
-        output_mask.putdata(mask)
-        output_mask.save(f'{filename_stub}.mask.png')
+        outputs['mask'] = np.where(levels == maximal, np.uint8(0), np.uint8(255))
 
-    if args.noise:
-        mapped = [y if y < 255 else 255 - random.randint(0,255) for y in mapped]
+    # noise stands in for the background, over the full range of the output
+    if noise != None:
+        values = noise.rows(levels.shape[0])
+        if depth.dtype != np.float32:
+            maximum = int(np.iinfo(depth.dtype).max)
+            values = np.minimum(values * (maximum + 1), maximum).astype(depth.dtype)
+        depth = np.where(levels >= top, values, depth)
+
+    outputs['depth'] = depth
+    return outputs
+
+def colour_splits(table, labels, grey):
+    # an RGB image with each pixel in its split's colour, or left grey for
+    # splits without one - a single lookup into the per-split table
+    colours, coloured = table
+    return np.where(coloured[labels][..., np.newaxis], colours[labels], grey[..., np.newaxis])
+
+def stretch_levels(levels, top, maximum):
+    # levels from 0 to top, rescaled to run from 0 to maximum
+    if top == maximum:
+        return levels
+    return (levels.astype(np.int64) * maximum + top // 2) // top
+
+def output_extension(args, name):
+    return 'npy' if name == 'depth' and args.depth_format == 'npy' else 'png'
+
+def save_image(pixels, filename):
+    # float maps are saved as they are, for loading with np.load (optionally
+    # memory mapped) - everything else is handed straight to Pillow rather
+    # than going through putdata
+    pixels = np.ascontiguousarray(pixels)
+    if pixels.dtype == np.float32:
+        np.save(filename, pixels)
+        return
+    mode = 'RGB' if pixels.ndim == 3 else ('I;16' if pixels.dtype == np.uint16 else 'L')
+    Image.frombuffer(mode, (pixels.shape[1], pixels.shape[0]), pixels, 'raw', mode, 0, 1).save(filename)
+
+@instrumented('write_file', 3)
+def write_file(args, filename, dimensions, points, splitmanager, test = False, mapping = None):
+    filename_stub = os.path.splitext(filename)[0]
+
+    # map the points with the provided splitmanager, unless the caller already has
+    if mapping == None:
+        mapping = splitmanager.makeLabelledLevels(points, args.compress_map, args.compress_tolerance)
+    mapping_results, mapping = mapping
+    print(f'mapping status was: {mapping_results}')
+    if(mapping_results != 'Success'):
+        print('as the mapping process was unsuccessful, no files will be written')
+        print('(did you allocate too many levels?)')
+        return (mapping_results, False)
+    levels, labels = mapping[:2]
 
-    # invert
-    inverted = [(255 - y) for y in mapped]
+    unowned = np.count_nonzero(labels == splitmanager.countSplits())
+    if unowned and (test or args.regions):
+        print(f'Unable to locate a split containing {unowned} pixels.')
 
-    output_image = Image.new('L', dimensions)
-    output_image.putdata(inverted)
-    output_image.save(f'{filename_stub}.depth.png')
+    with stage('render', levels.size):
+        maximal = levels.max() if args.mask else None
+        noise = None if test else frame_noise(args, filename_stub, levels.shape[1])
+        outputs = render_outputs(args, levels, labels, split_tables(splitmanager), maximal, test, noise)
+    for name, pixels in outputs.items():
+        with stage(f'encode {name}', levels.size):
+            save_image(pixels, f'{filename_stub}.{name}.{output_extension(args, name)}')
+    return (mapping_results, True)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('exrfile', nargs = '+', type = lambda x: is_valid_file(parser, x))
+    parser.add_argument('exrfile', nargs = '*', type = lambda x: is_valid_file(parser, x))
     parser.add_argument('--depth_cutoff', type = str, default = None)
     parser.add_argument('--compress_map', default = False, action = 'store_true')
+    parser.add_argument('--compress_tolerance', type = float, default = None)
     parser.add_argument('--interactive', default = False, action = 'store_true')
+    parser.add_argument('--script', type = str, default = None)
+    parser.add_argument('--quiet', default = False, action = 'store_true')
     parser.add_argument('--regions', default = False, action = 'store_true')
     parser.add_argument('--noise', default = False, action = 'store_true')
+    parser.add_argument('--noise_type', choices = NOISE_TYPES, default = 'uniform')
+    parser.add_argument('--noise_seed', type = int, default = 0)
     parser.add_argument('--mask', default = False, action = 'store_true')
+    parser.add_argument('--jobs', type = int, default = 1)
+    parser.add_argument('--preset', type = str, default = None)
+    parser.add_argument('--auto_splits', type = int, default = None)
+    parser.add_argument('--channel', dest = 'channels', action = 'append', type = parse_channel, default = None)
+    parser.add_argument('--levels', type = int, default = MAX_SPLIT_LEVELS)
+    parser.add_argument('--depth_format', choices = ['png', 'npy'], default = 'png')
+    parser.add_argument('--sequence', default = False, action = 'store_true')
+    parser.add_argument('--sequence_cache', type = str, default = None)
+    parser.add_argument('--stream', default = False, action = 'store_true')
+    parser.add_argument('--stream_rows', type = int, default = STREAM_BLOCK_ROWS)
+    parser.add_argument('--profile', type = str, default = None)
+    parser.add_argument('--probe', default = False, action = 'store_true')
+    parser.add_argument('--cache', type = str, default = None)
+    parser.add_argument('--cache_size', type = int, default = CACHE_SIZE)
+    parser.add_argument('--watch', type = str, default = None)
+    parser.add_argument('--watch_interval', type = float, default = 2.0)
+    parser.add_argument('--watch_settle', type = float, default = 5.0)
+    parser.add_argument('--watch_manifest', type = str, default = None)
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    if args.channels == None:
+        args.channels = [('Y', None)]
+    if len(set(channel_names(args))) != len(args.channels):
+        parser.error('each --channel can only be given once')
+    if args.script != None and (args.interactive or args.stream):
+        parser.error('--script cannot be combined with --interactive or --stream')
+    if args.quiet and args.script == None:
+        parser.error('--quiet only applies to --script')
+    if args.sequence and len(args.channels) > 1:
+        parser.error('--sequence works on a single --channel')
+    if args.watch == None and not args.exrfile:
+        parser.error('at least one exrfile is needed, unless using --watch')
+    if args.watch != None and not os.path.isdir(args.watch):
+        parser.error(f'folder {args.watch} does not exist!')
+    if args.watch != None and (args.interactive or args.sequence):
+        parser.error('--watch cannot be combined with --interactive or --sequence')
+    if args.watch != None and args.exrfile:
+        parser.error('--watch takes the place of listed exrfiles, so cannot be given both')
+    if args.compress_tolerance != None and not 0 < args.compress_tolerance < 1:
+        parser.error('--compress_tolerance must be between 0 and 1')
+    if not 2 <= args.levels <= MAX_LEVEL_BUDGET:
+        parser.error(f'--levels must be between 2 and {MAX_LEVEL_BUDGET}')
+    if args.noise_seed < 0:
+        parser.error('--noise_seed cannot be negative')
+    if args.cache_size < 1:
+        parser.error('--cache_size must be at least 1 (megabyte)')
+    sys.exit(main(args))
\ No newline at end of file
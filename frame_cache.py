@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+
+CACHE_SUFFIX = '.npz'
+
+def cache_key(*parts):
+    # a stable name for an entry, from anything json can represent
+    canonical = json.dumps(parts, sort_keys = True, separators = (',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def frame_identity(filename):
+    # a file is taken to be unchanged while its path, size and mtime are -
+    # much cheaper than hashing its contents, and what the sequence
+    # statistics and watch manifest go by already
+    stat = os.stat(filename)
+    return [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+
+class FrameCache:
+    # arrays worked out for a frame, kept on disk between runs under a key
+    # made from whatever they were worked out from. each entry is a single
+    # file, so several worker processes can share one cache - its mtime is
+    # refreshed whenever it is read, and the least recently used entries are
+    # removed once the cache grows past maxBytes
+    def __init__(self, directory, maxBytes):
+        self._directory = directory
+        self._maxBytes = maxBytes
+        os.makedirs(directory, exist_ok = True)
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + CACHE_SUFFIX)
+
+    def get(self, key):
+        # the arrays stored under the key, in the order they were put, or
+        # None - an entry that is damaged or evicted mid-read counts as missing
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = tuple(entry[f'arr_{i}'] for i in range(len(entry.files)))
+            os.utime(path)
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return None
+        return arrays
+
+    def put(self, key, *arrays):
+        if sum(a.nbytes for a in arrays) > self._maxBytes:
+            return
+        path = self._path(key)
+        # written aside and moved into place, so no reader sees half an entry
+        temporary = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(temporary, 'wb') as f:
+                np.savez(f, *arrays)
+            os.replace(temporary, path)
+        except OSError as e:
+            print(f'** unable to write to the cache in {self._directory}: {e}')
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        with os.scandir(self._directory) as found:
+            for entry in found:
+                if not entry.name.endswith(CACHE_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self._maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # already gone, most likely evicted by another worker
+                pass
+            total -= size
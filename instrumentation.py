@@ -0,0 +1,79 @@
+import contextlib
+import functools
+import time
+import tracemalloc
+
+class StageRecorder:
+    # collects wall time, throughput and (while tracemalloc is tracing) peak
+    # allocated memory for named, possibly nested, stages of work
+    def __init__(self):
+        self._records = []
+        self._stack = []
+
+    @contextlib.contextmanager
+    def stage(self, name, pixels = None):
+        tracing = tracemalloc.is_tracing()
+        frame = {'name': name, 'peak': 0, 'base': 0}
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            # tracemalloc has a single peak, so the enclosing stage keeps what
+            # it has seen so far before the peak is reset for this one
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['base'] = current
+        self._stack.append(frame)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            path = '/'.join(f['name'] for f in self._stack)
+            self._stack.pop()
+            peak = None
+            if tracing:
+                frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                peak = frame['peak'] - frame['base']
+                if self._stack:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'], frame['peak'])
+            self._records.append({
+                'stage': path,
+                'seconds': seconds,
+                'pixels': pixels,
+                'pixels_per_second': pixels / seconds if pixels and seconds > 0 else None,
+                'peak_bytes': peak,
+            })
+
+    def take(self):
+        # the records so far, innermost stages first, leaving the recorder empty
+        records = self._records
+        self._records = []
+        return records
+
+RECORDER = StageRecorder()
+stage = RECORDER.stage
+
+def instrumented(name, pixels_argument = None):
+    # decorates a function as a stage, counting pixels from the size of the
+    # array passed as the given positional argument
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            pixels = None
+            if pixels_argument != None and len(args) > pixels_argument:
+                pixels = getattr(args[pixels_argument], 'size', None)
+            with stage(name, pixels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def format_records(records):
+    lines = []
+    for record in records:
+        line = f' - {record["stage"]}: {record["seconds"] * 1000.0:.1f}ms'
+        if record['pixels_per_second']:
+            line += f', {record["pixels_per_second"] / 1e6:.1f}M pixels/s'
+        if record['peak_bytes'] != None:
+            line += f', peak {record["peak_bytes"] / 2**20:.1f}MB allocated'
+        lines.append(line)
+    return lines
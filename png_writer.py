@@ -0,0 +1,95 @@
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# colour type, channel count and bit depth for each supported image mode
+PNG_MODES = {
+    'L': (0, 1, 8),
+    'I;16': (0, 1, 16),
+    'RGB': (2, 3, 8),
+}
+
+class PngStreamWriter:
+    # writes a PNG a band of rows at a time, so the whole image never needs
+    # to be held in memory - rows must arrive top to bottom
+    def __init__(self, filename, width, height, mode = 'L'):
+        if mode not in PNG_MODES:
+            raise ValueError(f'unsupported PNG mode {mode}')
+        colourType, self._channels, bitDepth = PNG_MODES[mode]
+        # 16-bit samples are written big-endian, two bytes to a sample
+        self._sample = np.dtype('>u2') if bitDepth == 16 else np.dtype(np.uint8)
+        self._width = width
+        self._height = height
+        self._rows = 0
+        self._rowBytes = width * self._channels * self._sample.itemsize
+        self._previous = np.zeros(self._rowBytes, dtype = np.uint8)
+        self._compressor = zlib.compressobj(6)
+        self._file = open(filename, 'wb')
+        self._file.write(PNG_SIGNATURE)
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bitDepth, colourType, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type == None:
+            self.close()
+        else:
+            self._file.close()
+
+    def _chunk(self, kind, data):
+        self._file.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+
+    def writeRows(self, rows):
+        rows = np.ascontiguousarray(rows, dtype = self._sample).view(np.uint8).reshape(-1, self._rowBytes)
+        if rows.shape[0] == 0:
+            return
+        # every row uses the 'up' filter (type 2), which suits smooth depth maps
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype = np.uint8)
+        filtered[:, 0] = 2
+        filtered[0, 1:] = rows[0] - self._previous
+        filtered[1:, 1:] = rows[1:] - rows[:-1]
+        self._previous = rows[-1].copy()
+        self._rows += rows.shape[0]
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._chunk(b'IDAT', data)
+
+    def close(self):
+        data = self._compressor.flush()
+        if data:
+            self._chunk(b'IDAT', data)
+        self._chunk(b'IEND', b'')
+        self._file.close()
+        if self._rows != self._height:
+            raise ValueError(f'PNG declared {self._height} rows but {self._rows} were written')
+
+class NpyStreamWriter:
+    # the same interface for a float32 .npy file, written through a memory
+    # map, so it can be memory mapped again by whatever reads it
+    def __init__(self, filename, width, height):
+        self._height = height
+        self._rows = 0
+        self._array = np.lib.format.open_memmap(filename, mode = 'w+', dtype = np.float32, shape = (height, width))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type == None:
+            self.close()
+        else:
+            del self._array
+
+    def writeRows(self, rows):
+        rows = np.asarray(rows, dtype = np.float32).reshape(-1, self._array.shape[1])
+        self._array[self._rows:self._rows + rows.shape[0]] = rows
+        self._rows += rows.shape[0]
+
+    def close(self):
+        self._array.flush()
+        del self._array
+        if self._rows != self._height:
+            raise ValueError(f'npy declared {self._height} rows but {self._rows} were written')
@@ -1,5 +1,57 @@
+import bisect
+import json
+
+import numpy as np
+
+from instrumentation import instrumented
+
 EPSILON = 0.01
 MAX_SPLIT_LEVELS = 256
+# the most levels a manager can be given, filling a 16-bit image
+MAX_LEVEL_BUDGET = 1 << 16
+MAPPING_BLOCK = 1 << 20
+MAX_SKETCH_CELLS = 1 << 22
+# slots a sketch shares out between its cells for counting distinct depths,
+# with no fewer than MIN_SKETCH_SLOTS and no more than MAX_CELL_SLOTS to a cell
+MAX_SKETCH_SLOTS = 1 << 24
+MIN_SKETCH_SLOTS = 16
+MAX_CELL_SLOTS = 1 << 16
+# linear counting is trusted while at least 1 / SKETCH_RELIABLE_SHARE of a
+# cell's slots are still empty
+SKETCH_RELIABLE_SHARE = 8
+# histogram bins an automatic layout may place boundaries on
+AUTO_LAYOUT_BINS = 512
+
+def depthThresholds(bounds, dtype):
+    # the smallest value of dtype at or above each boundary, so that comparisons
+    # made in the depth buffer's own precision agree with float64 comparisons
+    bounds = np.asarray(bounds, dtype = np.float64)
+    thresholds = bounds.astype(dtype)
+    below = thresholds.astype(np.float64) < bounds
+    thresholds[below] = np.nextafter(thresholds[below], dtype.type(np.inf))
+    return thresholds
+
+def orderedBits(values):
+    # float bit patterns as integers in the same order as the floats - for
+    # negative floats, every bit but the sign is flipped
+    bits = values.view(np.int32 if values.dtype.itemsize == 4 else np.int64)
+    return bits ^ ((bits >> (bits.dtype.itemsize * 8 - 1)) & np.iinfo(bits.dtype).max)
+
+def mixedBits(bits):
+    # murmur3's finaliser, so that nearby bit patterns hash as if at random
+    if bits.dtype.itemsize == 4:
+        h = bits.view(np.uint32)
+        h = h ^ (h >> np.uint32(16))
+        h *= np.uint32(0x85EBCA6B)
+        h ^= h >> np.uint32(13)
+        h *= np.uint32(0xC2B2AE35)
+        return h ^ (h >> np.uint32(16))
+    h = bits.view(np.uint64)
+    h = h ^ (h >> np.uint64(33))
+    h *= np.uint64(0xFF51AFD7ED558CCD)
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xC4CEB9FE1A85EC53)
+    return h ^ (h >> np.uint64(33))
 
 class Split:
     def __init__(self, start, end):
@@ -9,25 +61,29 @@ class Split:
         self._flags = {}
 
     def _pointsToLevelMap(self, p):
-        points = sorted(list(set(p)))
+        points = np.unique(p).astype(np.float64)
         offset = self.getFlag('offset', 0)
         span = self.end - self.start
-        scalePoint = lambda x: (x - self.start)/span			
-        return {pkey: offset + (round(scalePoint(pkey) * self.levels)) for pkey in points}
+        scaled = np.round((points - self.start)/span * self.levels).astype(np.int64)
+        return dict(zip(points.tolist(), (offset + scaled).tolist()))
     
     def _pointsToLevelMapCompressed(self, p):
-        points = sorted(list(set(p)))
+        points = np.unique(p).astype(np.float64)
         offset = self.getFlag('offset', 0)
         pointCount = len(points)
-        mapping = {}
-        for point_index in range(pointCount):
-            mapping[points[point_index]] = offset + round((point_index / (pointCount - 1)) * self.levels)
-        return mapping			
+        # a lone depth sits at the start of the split's levels
+        ranks = np.arange(pointCount) / max(pointCount - 1, 1)
+        scaled = np.round(ranks * self.levels).astype(np.int64)
+        return dict(zip(points.tolist(), (offset + scaled).tolist()))
+
+    def containsMask(self, points):
+        # compare in float64 so float32 depths are judged exactly as contains() would
+        return (points >= np.float64(self.start)) & (points < np.float64(self.end))
 
     def pointsToLevelMap(self, points, compress = False):
         if self.levels == 0:
             return {}
-        relevant = [x for x in points if self.contains(x)]
+        relevant = points[self.containsMask(points)]
         if compress:
             return self._pointsToLevelMapCompressed(relevant)
         else:
@@ -60,12 +116,12 @@ class Split:
         }
         for flag, flag_value in self._flags.items():
             value[f'flag: {flag}'] = flag_value
-        if points:
-            relevant = [x for x in points if self.contains(x)]
+        if points is not None:
+            relevant = points[self.containsMask(points)]
             value.update({
-                'point_count': len(relevant),
-                'point_max': max(relevant),
-                'point_min': min(relevant),
+                'point_count': relevant.size,
+                'point_max': float(relevant.max()),
+                'point_min': float(relevant.min()),
                 'points': relevant
             })
         return value
@@ -90,10 +146,32 @@ class Split:
         self._levels = value
 
 class SplitManager:
-    def __init__(self, minDepth, maxDepth):
+    def __init__(self, minDepth, maxDepth, maxLevels = MAX_SPLIT_LEVELS):
+        # levels to share between the splits - the last is also where depths
+        # in splits without levels are put
+        self._maxLevels = maxLevels
         self._splits = [Split(minDepth, maxDepth + EPSILON)]
-        self._splits[0].levels = MAX_SPLIT_LEVELS
+        self._splits[0].levels = maxLevels
         self._splits[0].setFlag('label', 'Default')
+        # splits edited since the last remapLabelledLevels, with what changed
+        self._dirty = {}
+        self._reindex()
+
+    def _markDirty(self, change, *splits):
+        for split in splits:
+            self._dirty.setdefault(split, set()).add(change)
+
+    def _reindex(self):
+        # sorted boundary index, rebuilt whenever a split edge changes
+        self._starts = [sp.start for sp in self._splits]
+        self._ends = [sp.end for sp in self._splits]
+        self._thresholds = {}
+
+    def _indexForDepth(self, depth):
+        index = bisect.bisect_right(self._starts, depth) - 1
+        if index < 0 or depth >= self._ends[index]:
+            return None
+        return index
     
     def information(self, index, points = None):
         if index < 0 or index >= len(self._splits):
@@ -104,6 +182,7 @@ class SplitManager:
         if index < 0 or index >= len(self._splits):
             return (f'Error - index {index} out of range ({len(self._splits)} registered splits)', None)
         self._splits[index].setFlag(flag, value)
+        self._markDirty('flags', self._splits[index])
         return ('Success', self._splits[index].getFlag(flag))
     
     def getFlag(self, index, flag):
@@ -114,6 +193,7 @@ class SplitManager:
     def clearFlag(self, index, flag):
         if index < 0 or index >= len(self._splits):
             return (f'Error - index {index} out of range ({len(self._splits)} registered splits)', None)
+        self._markDirty('flags', self._splits[index])
         return ('Success', self._splits[index].clearFlag(flag))
 
     def getFlags(self, index):
@@ -124,28 +204,32 @@ class SplitManager:
     def countSplits(self):
         return len(self._splits)
 
+    def maxLevels(self):
+        return self._maxLevels
+
     def addSplit(self, depth):
         # first, determine which split currently holds this depth
-        owners = [sp for sp in self._splits if sp.contains(depth)]
-        if len(owners) == 0:
+        index = self._indexForDepth(depth)
+        if index == None:
             return ('Error - this point is outside the range of this depth map.', None)
-        if len(owners) > 1:
-            return ('Error - this point is somehow contained within two splits - this should never happen! You may need to restart.', None)
-        owner = owners[0]
+        owner = self._splits[index]
         newSplit = Split(depth, owner.end)
         owner.end = depth
-        self._splits.append(newSplit)
-        self._splits.sort(key = lambda x: x.start)
+        self._splits.insert(index + 1, newSplit)
+        self._markDirty('geometry', owner, newSplit)
+        self._reindex()
         return ('Success', newSplit)
     
     def moveSplit(self, fromDepth, toDepth):
         # is there a split that starts or ends on the desired depth? (it won't be both)
-        start_candidates = [x for x in self._splits if x.start == fromDepth]
-        end_candidates = [x for x in self._splits if x.end == fromDepth]
+        start_index = bisect.bisect_left(self._starts, fromDepth)
+        end_index = bisect.bisect_left(self._ends, fromDepth)
+        starts_here = start_index < len(self._starts) and self._starts[start_index] == fromDepth
+        ends_here = end_index < len(self._ends) and self._ends[end_index] == fromDepth
 
         # we are going to move the starting position of an identified split
-        if len(start_candidates) == 1:
-            split_index = self._splits.index(start_candidates[0])
+        if starts_here:
+            split_index = start_index
             if split_index == 0:
                 return (f'Error - will not move the start of the first split as this would cause the SplitManager to not cover the entire depthmap. Add a split at your proposed position instead.', False)
             if toDepth <= self._splits[split_index - 1].start:
@@ -154,10 +238,12 @@ class SplitManager:
                 return (f'Error - will not move the start of split {split_index} past its own ending - are you trying to delete a split?', False)
             self._splits[split_index].start = toDepth
             self._splits[split_index - 1].end = toDepth
+            self._markDirty('geometry', self._splits[split_index], self._splits[split_index - 1])
+            self._reindex()
             return ('Success', True)
         # we are going to move the end position of an identified split
-        elif len(end_candidates) == 1:
-            split_index = self._splits.index(end_candidates[0])
+        elif ends_here:
+            split_index = end_index
             if split_index == len(self._splits) - 1:
                 return (f'Error - will not move the end of the last split as this would cause the SplitManager to not cover the entire depthmap. Add a split at your proposed position instead.', False)
             if toDepth <= self._splits[split_index].start:
@@ -166,6 +252,8 @@ class SplitManager:
                 return (f'Error - will not move the end of split {split_index} past the end of split {split_index + 1} - are you trying to delete a split?', False)
             self._splits[split_index].end = toDepth
             self._splits[split_index + 1].start = toDepth
+            self._markDirty('geometry', self._splits[split_index], self._splits[split_index + 1])
+            self._reindex()
             return ('Success', True)
         else:
             return (f'Error - could not identify {fromDepth} as uniquely pointing to the start or end of any split.', None)
@@ -178,26 +266,41 @@ class SplitManager:
         
         if index == 0:
             self._splits[1].start = self._splits[0].start
+            self._markDirty('geometry', self._splits[1])
             del(self._splits[0])
+            self._reindex()
             return ('Success - Removed split 0 and expanded split 1 backwards.', True)
         else:
             self._splits[index - 1].end = self._splits[index].end
+            self._markDirty('geometry', self._splits[index - 1])
             del(self._splits[index])
+            self._reindex()
             return (f'Success - Removed split {index} and expanded split {index - 1} forwards.', True)
 
     def allocateLevels(self, index, levels):
         self._splits[index].levels = levels
+        self._markDirty('levels', self._splits[index])
         return self.totalLevels()
     
     def totalLevels(self):
         total = sum([x.levels for x in self._splits])
-        return (f'{total} levels allocated.', (total <= MAX_SPLIT_LEVELS))
+        return (f'{total} levels allocated.', (total <= self._maxLevels))
 
     def findSplitForDepth(self, depth):
-        for sp in self._splits:
-            if sp.contains(depth):
-                return ('Success', sp)
-        return (f'Unable to locate a split containing depth {depth}.', None)
+        index = self._indexForDepth(depth)
+        if index == None:
+            return (f'Unable to locate a split containing depth {depth}.', None)
+        return ('Success', self._splits[index])
+
+    def findSplitIndices(self, points):
+        # bulk findSplitForDepth - the owning split index for every depth in
+        # an array, or countSplits() for depths that no split contains
+        dtype = np.dtype(points.dtype)
+        if dtype not in self._thresholds:
+            self._thresholds[dtype] = depthThresholds(self._starts + self._ends[-1:], dtype)
+        labels = np.searchsorted(self._thresholds[dtype], points, side = 'right') - 1
+        labels[labels < 0] = len(self._splits)
+        return labels
 
     def indexOffsets(self):
         offset = 0
@@ -205,6 +308,444 @@ class SplitManager:
             split.setFlag('offset', offset)
             offset += split.levels
 
+    def toPreset(self):
+        # offsets are derived at mapping time, so they aren't worth keeping
+        return {
+            'boundaries': self.boundaries(),
+            'levels': [sp.levels for sp in self._splits],
+            'flags': [{k: sp.getFlag(k) for k in sp.getFlags() if k != 'offset'} for sp in self._splits],
+        }
+
+    def mappingConfig(self):
+        # just what decides the level and split of each depth - flags such as
+        # labels and colours are left out, so changing them keeps cached mappings
+        return {
+            'boundaries': self.boundaries(),
+            'levels': [sp.levels for sp in self._splits],
+            'maxLevels': self._maxLevels,
+        }
+
+    def applyPreset(self, preset):
+        try:
+            boundaries = [float(x) for x in preset['boundaries']]
+            levels = [int(x) for x in preset['levels']]
+            flags = preset.get('flags', [{}] * len(levels))
+        except (KeyError, TypeError, ValueError) as e:
+            return (f'Error - preset is malformed ({e!r}).', False)
+        if len(boundaries) < 2 or len(levels) != len(boundaries) - 1 or len(flags) != len(levels):
+            return ('Error - preset needs one level count and flag set per split, and one more boundary than splits.', False)
+        if any(a >= b for a, b in zip(boundaries, boundaries[1:])):
+            return ('Error - preset boundaries must be strictly increasing.', False)
+        # widen the outer edges so the preset still covers every depth this manager was built for
+        boundaries[0] = min(boundaries[0], self._starts[0])
+        boundaries[-1] = max(boundaries[-1], self._ends[-1])
+        splits = []
+        for index in range(len(levels)):
+            split = Split(boundaries[index], boundaries[index + 1])
+            split.levels = levels[index]
+            for flag, value in flags[index].items():
+                split.setFlag(flag, value)
+            splits.append(split)
+        self._splits = splits
+        self._markDirty('geometry', *splits)
+        self._reindex()
+        return ('Success', True)
+
+    def savePreset(self, filename):
+        try:
+            with open(filename, 'w') as f:
+                json.dump(self.toPreset(), f, separators = (',', ':'))
+        except OSError as e:
+            return (f'Error - unable to write preset {filename}: {e}', False)
+        return (f'Success - preset written to {filename}.', True)
+
+    def loadPreset(self, filename):
+        try:
+            with open(filename) as f:
+                preset = json.load(f)
+        except (OSError, ValueError) as e:
+            return (f'Error - unable to read preset {filename}: {e}', False)
+        message, loaded = self.applyPreset(preset)
+        if not loaded:
+            return (message, False)
+        return (f'Success - loaded {len(self._splits)} splits from {filename}.', True)
+
+    def autoLayout(self, counts, edges, splits, levels = None):
+        # replaces the splits with the layout of at most the given number that
+        # least distorts a histogram of the frame's depths. a split of width w
+        # holding n pixels, given l levels, has a squared quantization error of
+        # n * (w / l)^2 / 12 in all - the total is least when levels are shared
+        # in proportion to (n * w^2)^(1/3), so boundaries are placed on the
+        # histogram's edges to minimise the sum of that term, by dynamic
+        # programming. splits over empty stretches of depth cost nothing, and
+        # are left without levels
+        if levels == None:
+            levels = self._maxLevels
+        counts = np.asarray(counts, dtype = np.float64)
+        edges = np.asarray(edges, dtype = np.float64)
+        if len(counts) > AUTO_LAYOUT_BINS:
+            firsts = np.arange(0, len(counts), -(-len(counts) // AUTO_LAYOUT_BINS))
+            counts = np.add.reduceat(counts, firsts)
+            edges = edges[np.append(firsts, len(edges) - 1)]
+        splits = min(splits, len(counts), levels)
+        if splits < 1 or counts.sum() == 0:
+            return ('Error - an automatic layout needs at least one split, one level and some depths to lay out.', False)
+        # a frame of a single depth, like an empty render, has nothing to lay
+        # out - it gets the one default split, as it would without a layout
+        if np.any(np.diff(edges) <= 0):
+            self.applyPreset({'boundaries': [self._starts[0], self._ends[-1]], 'levels': [levels], 'flags': [{'label': 'Default'}]})
+            return ('Success - every depth is the same, so the single default split was kept.', True)
+
+        # cost[i, j] is the term for one split over bins i to j - 1, and
+        # best[j] the least total for bins 0 to j - 1 with the splits so far
+        totals = np.concatenate([[0.0], np.cumsum(counts)])
+        with np.errstate(invalid = 'ignore'):
+            cost = np.cbrt((totals[None, :] - totals[:, None]) * (edges[None, :] - edges[:, None]) ** 2)
+        cost[np.tril_indices(len(edges))] = np.inf
+        best = cost[0]
+        choices = []
+        layouts = [self._autoLevels(totals, edges, [0, len(edges) - 1], levels)]
+        for count in range(1, splits):
+            options = best[:, None] + cost
+            choices.append(np.argmin(options, axis = 0))
+            best = options[choices[-1], np.arange(len(edges))]
+            bounds = [len(edges) - 1]
+            for choice in reversed(choices):
+                bounds.insert(0, int(choice[bounds[0]]))
+            layouts.append(self._autoLevels(totals, edges, [0] + bounds, levels))
+        # levels are whole numbers, so more splits can do worse - the fewest
+        # splits with the least error win
+        layouts = [layout for layout in layouts if layout != None]
+        if not layouts:
+            return (f'Error - more splits hold depths than the {levels} levels available.', False)
+        bounds, allocation, error = min(layouts, key = lambda layout: layout[2])
+
+        message, applied = self.applyPreset({
+            'boundaries': edges[bounds].tolist(),
+            'levels': allocation.tolist(),
+            'flags': [{'label': f'Auto {index}'} for index in range(len(allocation))],
+        })
+        if not applied:
+            return (message, False)
+        return (f'Success - laid out {len(allocation)} splits, with an estimated rms error of {error:.4g} in depth.', True)
+
+    def _autoLevels(self, totals, edges, bounds, levels):
+        # at least one level for every split holding depths, then the rest by
+        # largest remainder, with the rms error that results
+        pixels = np.diff(totals[bounds])
+        widths = np.diff(edges[bounds])
+        allocation = (pixels > 0).astype(np.int64)
+        if allocation.sum() > levels:
+            return None
+        terms = np.cbrt(pixels * widths ** 2)
+        shares = (levels - allocation.sum()) * terms / max(terms.sum(), 1e-300)
+        allocation += np.floor(shares).astype(np.int64)
+        remainder = levels - allocation.sum()
+        allocation[np.argsort(np.floor(shares) - shares, kind = 'stable')[:remainder]] += 1
+        steps = widths / np.maximum(allocation, 1)
+        error = float(np.sqrt(np.sum(pixels * steps ** 2 * (allocation > 0)) / 12.0 / pixels.sum()))
+        return (bounds, allocation, error)
+
+    def boundaries(self):
+        return self._starts + self._ends[-1:]
+
+    def _levelsLinear(self, points, labelled = False):
+        # per-split parameters, with a trailing entry for depths no split owns
+        starts = np.array([sp.start for sp in self._splits] + [0.0])
+        spans = np.array([sp.end - sp.start for sp in self._splits] + [1.0])
+        levels = np.array([sp.levels for sp in self._splits] + [0], dtype = np.float64)
+        offsets = np.array([sp.getFlag('offset', 0) for sp in self._splits] + [0], dtype = np.int32)
+        flat = points.reshape(-1)
+        result = np.empty(flat.size, dtype = np.int32)
+        allLabels = np.empty(flat.size, dtype = np.int32) if labelled else None
+        for block in range(0, flat.size, MAPPING_BLOCK):
+            depths = flat[block:block + MAPPING_BLOCK]
+            labels = self.findSplitIndices(depths)
+            scaled = np.round((depths.astype(np.float64) - starts[labels]) / spans[labels] * levels[labels])
+            mapped = offsets[labels] + scaled.astype(np.int32)
+            result[block:block + MAPPING_BLOCK] = np.where(levels[labels] > 0, mapped, self._maxLevels - 1)
+            if labelled:
+                allLabels[block:block + MAPPING_BLOCK] = labels
+        if labelled:
+            return (result.reshape(points.shape), allLabels.reshape(points.shape))
+        return result.reshape(points.shape)
+
+    def _levelsCompressed(self, points, labelled = False):
+        depths, inverse = np.unique(points, return_inverse = True)
+        result = self._compressedTable(depths)[inverse].reshape(points.shape)
+        if labelled:
+            labels = self.findSplitIndices(depths).astype(np.int32)[inverse].reshape(points.shape)
+            return (result, labels)
+        return result
+
+    def _compressedTable(self, depths):
+        # distinct depths are sorted, so each split owns one contiguous run of them
+        edges = np.searchsorted(depths, depthThresholds(self.boundaries(), depths.dtype), side = 'left')
+        table = np.full(depths.size, self._maxLevels - 1, dtype = np.int32)
+        for index, split in enumerate(self._splits):
+            low, high = edges[index], edges[index + 1]
+            if split.levels == 0 or high == low:
+                continue
+            ranks = np.arange(high - low) / max(high - low - 1, 1)
+            table[low:high] = split.getFlag('offset', 0) + np.round(ranks * split.levels).astype(np.int32)
+        return table
+
+    def makeLevelSketch(self, points, tolerance, sketch = None):
+        # for approximate map compression - depths are counted into cells of
+        # relative width no more than tolerance, and blocks of the same frame
+        # can be added to a sketch by passing it back in
+        if sketch == None:
+            sketch = self._emptySketch(np.dtype(points.dtype), tolerance)
+        flat = points.reshape(-1)
+        for block in range(0, flat.size, MAPPING_BLOCK):
+            self._addToSketch(sketch, flat[block:block + MAPPING_BLOCK])
+        return sketch
+
+    def _emptySketch(self, dtype, tolerance):
+        if dtype.kind != 'f' or dtype.itemsize not in (4, 8):
+            raise ValueError(f'unable to sketch depths of type {dtype}')
+        # a float's bit pattern counts up through the representable values, so
+        # dropping the low bits of the mantissa leaves cells of a fixed
+        # relative width, each holding the same number of representable values
+        mantissa = np.finfo(dtype).nmant
+        shift = int(np.clip(np.floor(np.log2(tolerance)) + mantissa, 0, mantissa))
+        edges = [int(e) for e in orderedBits(depthThresholds(self.boundaries(), dtype))]
+        while (edges[-1] >> shift) - (edges[0] >> shift) > MAX_SKETCH_CELLS:
+            shift += 1
+        base = edges[0] >> shift
+        # a split's cells are offset by its index, so a cell that straddles a
+        # boundary becomes one cell on each side, and a last cell collects
+        # every depth that no split owns
+        firsts = np.array([(e >> shift) - base + index for index, e in enumerate(edges)])
+        # each cell keeps its pixel count and the lowest and highest depth in
+        # it, as bit patterns, along with a row of slots marking the hashes of
+        # the depths it has seen
+        cells = int(firsts[-1]) + 1
+        bits = np.int32 if dtype.itemsize == 4 else np.int64
+        slots = int(np.clip(2 ** np.floor(np.log2(MAX_SKETCH_SLOTS / cells)), MIN_SKETCH_SLOTS, MAX_CELL_SLOTS))
+        return {
+            'dtype': dtype,
+            'shift': shift,
+            'base': base,
+            'firsts': firsts,
+            'counts': np.zeros(cells, dtype = np.int64),
+            'low': np.full(cells, np.iinfo(bits).max, dtype = bits),
+            'high': np.full(cells, np.iinfo(bits).min, dtype = bits),
+            'slots': slots,
+            'seen': np.zeros(cells * slots, dtype = bool),
+        }
+
+    def _sketchKeys(self, depths, sketch):
+        # the cell of every depth, and the depths as bit patterns
+        labels = self.findSplitIndices(depths)
+        bits = orderedBits(depths)
+        keys = (bits >> sketch['shift']) - sketch['base'] + labels
+        keys[labels == len(self._splits)] = sketch['firsts'][-1]
+        return (keys, bits)
+
+    def _addToSketch(self, sketch, depths):
+        keys, bits = self._sketchKeys(depths, sketch)
+        sketch['counts'] += np.bincount(keys, minlength = sketch['counts'].size)
+        np.minimum.at(sketch['low'], keys, bits)
+        np.maximum.at(sketch['high'], keys, bits)
+        # slots are kept few enough to index in 32 bits
+        slot = (mixedBits(bits) & (sketch['slots'] - 1)).astype(np.int32)
+        slot += keys.astype(np.int32) * np.int32(sketch['slots'])
+        sketch['seen'][slot] = True
+        return (keys, bits)
+
+    def _sketchTables(self, sketch):
+        # for every cell, the level of its lowest depth within its split, the
+        # levels to add per representable depth above that, and its split's
+        # offset and index. a cell's pixels
+        # are first taken to fall at random among the representable depths
+        # between its lowest and highest, which gives the number of distinct
+        # depths it is expected to hold - but depths quantised more coarsely
+        # than the buffer, as from a HALF channel, or evenly spaced, hold far
+        # fewer or more. so the depths' hashes also mark a row of slots, and
+        # where the share left empty gives a clearly different count, by linear
+        # counting, that count is taken instead. cells are ranked by the running
+        # total the way _compressedTable ranks distinct depths, and depths
+        # within a cell are taken to be spread evenly between its lowest and
+        # highest
+        firsts = sketch['firsts']
+        slots = sketch['slots']
+        bases = np.full(sketch['counts'].size, self._maxLevels - 1, dtype = np.float32)
+        steps = np.zeros(sketch['counts'].size, dtype = np.float32)
+        offsets = np.zeros(sketch['counts'].size, dtype = np.int32)
+        labels = np.full(sketch['counts'].size, len(self._splits), dtype = np.int32)
+        empty = slots - sketch['seen'].reshape(-1, slots).sum(axis = 1)
+        for index, split in enumerate(self._splits):
+            low, high = firsts[index], firsts[index + 1]
+            labels[low:high] = index
+            counts = sketch['counts'][low:high]
+            occupied = np.nonzero(counts)[0]
+            if split.levels == 0 or len(occupied) == 0:
+                continue
+            spread = np.maximum(sketch['high'][low:high].astype(np.float64) - sketch['low'][low:high], 0)
+            representable = spread + 1
+            cell_empty = empty[low:high]
+            with np.errstate(divide = 'ignore'):
+                counted = slots * np.log(slots / cell_empty)
+            scattered = representable * -np.expm1(-counts / representable)
+            # the scattered estimate stands unless the slots clearly disagree -
+            # by three standard deviations of linear counting at that many
+            load = scattered / slots
+            deviation = np.sqrt(slots * np.maximum(np.expm1(load) - load, 0))
+            disagree = (cell_empty * SKETCH_RELIABLE_SHARE >= slots) & (np.abs(counted - scattered) > 3 * deviation)
+            distinct = np.where(disagree, counted, scattered)
+            # a cell holds no more distinct depths than pixels or representable
+            # depths, and always holds its lowest and highest
+            distinct = np.minimum(distinct, np.minimum(counts, representable))
+            distinct = np.maximum(distinct, np.minimum(counts, 1 + (spread > 0)))
+            ranks = np.cumsum(distinct) - distinct
+            total = ranks[occupied[-1]] + distinct[occupied[-1]] - 1
+            scale = split.levels / max(total, 1)
+            bases[low:high] = ranks * scale
+            steps[low:high] = np.where(spread > 0, (distinct - 1) / np.maximum(spread, 1), 0) * scale
+            offsets[low:high] = split.getFlag('offset', 0)
+        return (bases, steps, offsets, labels)
+
+    def _sketchedLevels(self, sketch, tables, keys, bits):
+        # in single precision, which is plenty for 16-bit levels - rounded
+        # before the offset is added, as _compressedTable does, so that ties
+        # round the same way whatever the split's offset
+        bases, steps, offsets, labels = tables
+        levels = (bits - sketch['low'][keys]).astype(np.float32)
+        levels *= steps[keys]
+        levels += bases[keys]
+        np.rint(levels, out = levels)
+        return (levels.astype(np.int32) + offsets[keys], labels[keys])
+
+    def _levelsSketched(self, points, tolerance, labelled = False):
+        sketch = self._emptySketch(np.dtype(points.dtype), tolerance)
+        flat = points.reshape(-1)
+        keys = np.empty(flat.size, dtype = np.int32)
+        bits = np.empty(flat.size, dtype = sketch['low'].dtype)
+        for block in range(0, flat.size, MAPPING_BLOCK):
+            keys[block:block + MAPPING_BLOCK], bits[block:block + MAPPING_BLOCK] = self._addToSketch(sketch, flat[block:block + MAPPING_BLOCK])
+        result, labels = self._sketchedLevels(sketch, self._sketchTables(sketch), keys, bits)
+        if labelled:
+            return (result.reshape(points.shape), labels.reshape(points.shape))
+        return result.reshape(points.shape)
+
+    def _levelsFor(self, points, compress, tolerance, labelled = False):
+        if compress and tolerance:
+            return self._levelsSketched(points, tolerance, labelled)
+        if compress:
+            return self._levelsCompressed(points, labelled)
+        return self._levelsLinear(points, labelled)
+
+    @instrumented('makeLevels', 1)
+    def makeLevels(self, points, compress = False, tolerance = None):
+        # vectorised equivalent of makeMapping followed by a per-pixel lookup -
+        # with a tolerance, compression ranks depths from a sketch instead
+        message, safe_levels = self.totalLevels()
+        if safe_levels == False:
+            return (f'Failure to map: {message}', None)
+        self.indexOffsets()
+        return ('Success', self._levelsFor(points, compress, tolerance))
+
+    @instrumented('makeLabelledLevels', 1)
+    def makeLabelledLevels(self, points, compress = False, tolerance = None):
+        # as makeLevels, but the value is a (levels, labels) pair, with the
+        # owning split of every depth taken from the same searchsorted pass
+        message, safe_levels = self.totalLevels()
+        if safe_levels == False:
+            return (f'Failure to map: {message}', None)
+        self.indexOffsets()
+        return ('Success', self._levelsFor(points, compress, tolerance, True))
+
+    def makeSketchedLevels(self, points, sketch):
+        # labelled levels ranked from a sketch built by makeLevelSketch, for
+        # mapping a frame a block at a time with approximate compression
+        message, safe_levels = self.totalLevels()
+        if safe_levels == False:
+            return (f'Failure to map: {message}', None)
+        self.indexOffsets()
+        # the tables only depend on the sketch, so are kept with it for the next block
+        if 'tables' not in sketch:
+            sketch['tables'] = self._sketchTables(sketch)
+        keys, bits = self._sketchKeys(points, sketch)
+        levels, labels = self._sketchedLevels(sketch, sketch['tables'], keys, bits)
+        return ('Success', (levels.reshape(points.shape), labels.reshape(points.shape)))
+
+    @instrumented('remapLabelledLevels', 1)
+    def remapLabelledLevels(self, points, previous = None, compress = False, tolerance = None):
+        # as makeLabelledLevels, but given the previous result for the same
+        # points it recomputes only the pixels of splits whose bounds or levels
+        # have changed since, shifting the rest by their change in offset - the
+        # value is a (levels, labels, state) triple to hand back next time, and
+        # the previous buffers are updated in place
+        message, safe_levels = self.totalLevels()
+        if safe_levels == False:
+            return (f'Failure to map: {message}', None)
+        self.indexOffsets()
+        state = {
+            'compress': compress,
+            'tolerance': tolerance,
+            'bounds': (self._starts[0], self._ends[-1]),
+            'splits': [(sp, sp.getFlag('offset', 0)) for sp in self._splits],
+        }
+        if previous == None or previous[2]['compress'] != compress or previous[2]['tolerance'] != tolerance:
+            levels, labels = self._levelsFor(points, compress, tolerance, True)
+            self._dirty = {}
+            return ('Success', (levels, labels, state))
+
+        levels, labels, previous_state = previous
+        current = {sp: index for index, sp in enumerate(self._splits)}
+        # old label -> new label, or -1 where the pixels must be recomputed;
+        # the trailing entry covers pixels that no split owned, which stay
+        # that way unless the outer bounds have moved
+        count = len(previous_state['splits'])
+        relabel = np.full(count + 1, -1, dtype = np.int32)
+        shift = np.zeros(count + 1, dtype = np.int32)
+        if previous_state['bounds'] == state['bounds']:
+            relabel[count] = len(self._splits)
+        for index, (split, offset) in enumerate(previous_state['splits']):
+            changes = self._dirty.get(split, set())
+            if split not in current or 'geometry' in changes or 'levels' in changes:
+                continue
+            relabel[index] = current[split]
+            if split.levels > 0:
+                shift[index] = split.getFlag('offset', 0) - offset
+
+        # every gather below is a full pass over the frame, so each is only
+        # made when it changes something
+        stale_labels = np.nonzero(relabel < 0)[0]
+        if len(stale_labels) == 0:
+            stale = None
+        elif stale_labels[-1] - stale_labels[0] == len(stale_labels) - 1:
+            stale = (labels >= stale_labels[0]) & (labels <= stale_labels[-1])
+        else:
+            stale = relabel[labels] < 0
+        if shift.any():
+            levels += shift[labels]
+        kept = relabel >= 0
+        if (relabel[kept] != np.arange(count + 1)[kept]).any():
+            labels[:] = relabel[labels]
+        if stale is not None:
+            # flat indices are cheaper to reuse than a boolean mask
+            stale = np.flatnonzero(stale)
+            subset = points.reshape(-1)[stale]
+            subset_levels, subset_labels = self._levelsFor(subset, compress, tolerance, True)
+            levels.reshape(-1)[stale] = subset_levels
+            labels.reshape(-1)[stale] = subset_labels
+        self._dirty = {}
+        return ('Success', (levels, labels, state))
+
+    def makeLevelTable(self, depths, compress = False):
+        # levels for a sorted array of distinct depths, for mapping a frame a
+        # block at a time - look blocks up with searchsorted against depths
+        message, safe_levels = self.totalLevels()
+        if safe_levels == False:
+            return (f'Failure to map: {message}', None)
+        self.indexOffsets()
+        if compress:
+            return ('Success', self._compressedTable(depths))
+        return ('Success', self._levelsLinear(depths))
+
+    @instrumented('makeMapping', 1)
     def makeMapping(self, points, compress = False):
         message, safe_levels = self.totalLevels()
         if safe_levels == False:
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from format_depthmap import compute_histogram, histogram_edges
+
+# compute_histogram finds evenly spaced bins by arithmetic - it must count
+# just as np.histogram does over the same edges, NaN and infinities aside
+
+@pytest.mark.parametrize('bins', [1, 7, 20, 512])
+@pytest.mark.parametrize('width', [1e-3, 1.0, 500.0, 1e5])
+def test_histogram_matches_numpy(bins, width):
+    rng = np.random.default_rng([bins, int(width * 1000)])
+    for trial in range(20):
+        low = float(rng.uniform(-100, 1000))
+        high = low + width
+        points = rng.uniform(low - width * 0.1, high + width * 0.1, 4000).astype(np.float32)
+        # depths on and beside the edges, where rounding could go either way
+        edges = histogram_edges(low, high, bins).astype(np.float32)[rng.integers(0, bins + 1, 1000)]
+        points[:1000] = np.nextafter(edges, rng.choice(np.array([-np.inf, np.inf], dtype = np.float32), 1000))
+        points[1000:2000] = edges
+        points[2000:2030] = rng.choice(np.array([np.nan, np.inf, -np.inf], dtype = np.float32), 30)
+        counts, edges = compute_histogram(points, bins, depth_range = (low, high))
+        finite = points[np.isfinite(points)].astype(np.float64)
+        np.testing.assert_array_equal(counts, np.histogram(finite, edges)[0])
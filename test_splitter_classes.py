@@ -0,0 +1,166 @@
+import numpy as np
+import pytest
+
+from splitter_classes import SplitManager, MAX_SPLIT_LEVELS
+
+# makeMapping is the reference, per-depth path - the vectorised makeLevels and
+# makeLabelledLevels must agree with it exactly, pixel for pixel
+
+def random_layout(rng, points, max_levels = MAX_SPLIT_LEVELS):
+    # a manager over the middle of the points' range, so that some depths fall
+    # outside every split, cut at random depths and at depths in the frame,
+    # with levels shared out at random and some splits left with none
+    low, high = float(points.min()), float(points.max())
+    span = high - low
+    sm = SplitManager(low + span * 0.05, high - span * 0.05, max_levels)
+    for cut in np.sort(rng.random(rng.integers(0, 10)) * span + low):
+        sm.addSplit(float(cut) if rng.random() < 0.7 else float(points.flat[rng.integers(points.size)]))
+    budget = max_levels
+    for index in range(sm.countSplits()):
+        levels = int(rng.integers(0, budget // 2 + 1)) if rng.random() < 0.8 else 0
+        sm.allocateLevels(index, levels)
+        budget -= levels
+    return sm
+
+def random_points(rng, kind):
+    if kind == 'gradient':
+        return (rng.random((37, 53)) * 400 + 100).astype(np.float32)
+    if kind == 'planes':
+        return rng.choice(np.array([100, 150.5, 200, 200.25, 499.99], dtype = np.float32), size = (40, 40))
+    points = np.full((30, 30), 500, dtype = np.float32)
+    points[:10] = (rng.random((10, 30)) * 100 + 120).astype(np.float32)
+    return points
+
+def with_boundary_depths(points, sm):
+    # every boundary as a float32 depth, along with its float32 neighbours
+    # either side, in place of some of the frame's pixels
+    bounds = np.array(sm.boundaries(), dtype = np.float32)
+    edges = np.concatenate([
+        bounds,
+        np.nextafter(bounds, np.float32(-np.inf)),
+        np.nextafter(bounds, np.float32(np.inf)),
+    ])
+    points = points.copy()
+    points.reshape(-1)[:edges.size] = edges
+    return points
+
+def reference_levels(sm, points, compress, max_levels):
+    message, mapping = sm.makeMapping(points, compress)
+    assert message == 'Success'
+    return np.array([mapping.get(float(p), max_levels - 1) for p in points.reshape(-1)]).reshape(points.shape)
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('kind', ['gradient', 'planes', 'background'])
+@pytest.mark.parametrize('max_levels', [MAX_SPLIT_LEVELS, 1000])
+def test_levels_match_mapping(compress, kind, max_levels):
+    rng = np.random.default_rng([int(compress), len(kind), max_levels])
+    for trial in range(40):
+        points = random_points(rng, kind)
+        sm = random_layout(rng, points, max_levels)
+        points = with_boundary_depths(points, sm)
+        expected = reference_levels(sm, points, compress, max_levels)
+        message, levels = sm.makeLevels(points, compress)
+        assert message == 'Success'
+        np.testing.assert_array_equal(levels, expected)
+        message, (labelled, labels) = sm.makeLabelledLevels(points, compress)
+        np.testing.assert_array_equal(labelled, expected)
+        np.testing.assert_array_equal(labels, sm.findSplitIndices(points))
+
+def test_zero_level_and_unowned_depths_are_background():
+    sm = SplitManager(100.0, 200.0)
+    sm.addSplit(150.0)
+    sm.allocateLevels(0, 0)
+    sm.allocateLevels(1, 100)
+    points = np.array([[99.0, 120.0, 150.0, 250.0]], dtype = np.float32)
+    for compress in [False, True]:
+        expected = reference_levels(sm, points, compress, MAX_SPLIT_LEVELS)
+        assert expected[0, 0] == expected[0, 1] == expected[0, 3] == MAX_SPLIT_LEVELS - 1
+        np.testing.assert_array_equal(sm.makeLevels(points, compress)[1], expected)
+
+def test_overallocation_fails_both_paths():
+    sm = SplitManager(100.0, 200.0)
+    sm.addSplit(150.0)
+    sm.allocateLevels(0, MAX_SPLIT_LEVELS)
+    sm.allocateLevels(1, 1)
+    points = np.array([120.0, 180.0], dtype = np.float32)
+    assert sm.makeMapping(points)[1] == False
+    assert sm.makeLevels(points)[1] is None
+
+def test_auto_layout_of_a_single_depth_keeps_the_default_split():
+    sm = SplitManager(300.0, 300.0)
+    sm.addSplit(300.0)
+    edges = np.full(513, 300.0)
+    counts = np.zeros(512)
+    counts[-1] = 100
+    message, laid_out = sm.autoLayout(counts, edges, 8)
+    assert laid_out
+    assert sm.countSplits() == 1
+    assert sm.mappingConfig()['levels'] == [MAX_SPLIT_LEVELS]
+    points = np.full((4, 4), 300.0, dtype = np.float32)
+    np.testing.assert_array_equal(sm.makeLevels(points)[1], reference_levels(sm, points, False, MAX_SPLIT_LEVELS))
+
+def sketch_points(rng, kind):
+    shape = (300, 400)
+    points = (rng.random(shape) * 900 + 100).astype(np.float32)
+    if kind == 'gradient':
+        return np.linspace(100, 5000, points.size, dtype = np.float32).reshape(shape)
+    if kind == 'half':
+        return points.astype(np.float16).astype(np.float32)
+    if kind == 'cluster':
+        points[:, :130] = (300 + rng.normal(0, 0.5, (shape[0], 130))).astype(np.float32)
+    if kind == 'grid':
+        points[:, :200] = np.round(points[:, :200] * 10) / 10
+    return points
+
+# a cluster this dense outnumbers the slots of its cell at 0.01, so is left
+# to the finer tolerance
+@pytest.mark.parametrize('kind, tolerance', [(kind, tolerance) for kind in ['gradient', 'random', 'half', 'grid'] for tolerance in [0.01, 0.001]] + [('cluster', 0.001)])
+def test_sketched_levels_are_within_a_level_of_exact(kind, tolerance):
+    # quantised depths, like those from a HALF channel or on a grid, and
+    # clusters hold far fewer distinct depths than their spread suggests
+    rng = np.random.default_rng([len(kind), int(tolerance * 1000)])
+    points = sketch_points(rng, kind)
+    sm = SplitManager(float(points.min()), float(points.max()))
+    exact = sm.makeLevels(points, True)[1]
+    np.testing.assert_array_less(np.abs(sm.makeLevels(points, True, tolerance)[1] - exact), 2)
+    for cut in np.linspace(float(points.min()), float(points.max()), 5)[1:-1]:
+        sm.addSplit(float(cut))
+    for index, levels in enumerate([100, 50, 60, 40]):
+        sm.allocateLevels(index, levels)
+    exact = sm.makeLevels(points, True)[1]
+    np.testing.assert_array_less(np.abs(sm.makeLevels(points, True, tolerance)[1] - exact), 2)
+
+def random_edit(rng, sm, points):
+    # one edit of the kind the shell makes, which may well be refused
+    edit = rng.integers(5)
+    index = int(rng.integers(sm.countSplits()))
+    if edit == 0:
+        sm.addSplit(float(points.flat[rng.integers(points.size)]))
+    elif edit == 1:
+        bounds = sm.boundaries()
+        depth = bounds[rng.integers(1, len(bounds) - 1)] if len(bounds) > 2 else bounds[0]
+        sm.moveSplit(depth, depth + float(rng.normal(0, 20)))
+    elif edit == 2:
+        sm.removeSplit(index)
+    elif edit == 3:
+        sm.allocateLevels(index, int(rng.integers(0, MAX_SPLIT_LEVELS // 2)))
+    else:
+        sm.setFlag(index, 'label', f'edit {rng.integers(100)}')
+
+@pytest.mark.parametrize('compress, tolerance', [(False, None), (True, None), (True, 0.001)])
+def test_remapped_levels_match_a_fresh_mapping(compress, tolerance):
+    rng = np.random.default_rng([int(compress), int(bool(tolerance))])
+    for trial in range(6):
+        points = random_points(rng, ['gradient', 'planes', 'background'][trial % 3])
+        sm = random_layout(rng, points)
+        message, mapping = sm.remapLabelledLevels(points, None, compress, tolerance)
+        for edit in range(25):
+            random_edit(rng, sm, points)
+            message, remapped = sm.remapLabelledLevels(points, mapping, compress, tolerance)
+            if remapped == None:
+                # over-allocated, so the edit is left for the next remap
+                continue
+            mapping = remapped
+            levels, labels = sm.makeLabelledLevels(points, compress, tolerance)[1]
+            np.testing.assert_array_equal(mapping[0], levels)
+            np.testing.assert_array_equal(mapping[1], labels)